@@ -1,6 +1,7 @@
 from sqlalchemy import (
     create_engine,
 )
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -12,6 +13,36 @@ if not DATABASE_URL:
     raise ValueError("DATABASE_URL is not set in the environment variables")
 
 
-engine = create_engine(DATABASE_URL)
+def to_async_url(url: str) -> str:
+    # Point a sync database URL at the matching async driver
+    for prefix, async_prefix in (
+        ("postgresql://", "postgresql+asyncpg://"),
+        ("postgresql+psycopg2://", "postgresql+asyncpg://"),
+        ("sqlite://", "sqlite+aiosqlite://"),
+    ):
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix) :]
+    return url
+
+
+# Pre-ping replaces connections the server dropped, recycle retires them before
+# server-side idle timeouts do
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, pool_recycle=1800)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
+
+# The request handlers all use the async engine, so it gets the sized pool.
+# Keep DB_POOL_SIZE + DB_MAX_OVERFLOW times the worker count under max_connections
+pool_options = {"pool_pre_ping": True, "pool_recycle": 1800}
+if not DATABASE_URL.startswith("sqlite"):
+    pool_options.update(
+        pool_size=int(os.getenv("DB_POOL_SIZE", 20)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=30,
+    )
+
+# Async engine for handlers that shouldn't block the event loop on DB round trips
+async_engine = create_async_engine(to_async_url(DATABASE_URL), **pool_options)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
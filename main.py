@@ -1,8 +1,10 @@
 from fastapi import FastAPI, status, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from slowapi import Limiter
+from sqlalchemy.exc import SQLAlchemyError
 from routes import users, files, collaboration, ai
+import logging
 import os
 from db import engine, Base
 from fastapi.openapi.utils import get_openapi
@@ -13,11 +15,14 @@ from slowapi.middleware import SlowAPIMiddleware
 from slowapi.errors import RateLimitExceeded
 
 Base.metadata.create_all(bind=engine)
+# Indexes added to the models after a table was created come from migrate.py
+logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title="Real-Time Collaborative Code - Editor ",
     description="A Fast-api powered real time ai editor with specific out of the world ai support for python and js",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 limiter = Limiter(
     key_func=get_remote_address,  # Uses client IP for rate limiting
@@ -25,7 +30,9 @@ limiter = Limiter(
         "500000/day",
         "500/minute",
     ],
-    storage_uri="memory://",  # Uses in-memory storage(ram) it will reset if the server resets it is for this app only have to use any other database in big productions
+    # Redis keeps one atomic counter shared by every worker; memory:// is per process
+    storage_uri=os.getenv("REDIS_URL", "memory://"),
+    strategy="moving-window",
 )
 
 
@@ -35,12 +42,25 @@ app.add_middleware(SlowAPIMiddleware)
 
 @app.exception_handler(RateLimitExceeded)
 async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_429_TOO_MANY_REQUESTS,
         content={"error": "Too many requests. Please try again later."},
     )
 
 
+@app.exception_handler(SQLAlchemyError)
+async def database_error_handler(request: Request, exc: SQLAlchemyError):
+    # One place for every route's database failures. The details go to the log,
+    # the client gets a fixed body. The request's session rolls back as it closes
+    logger.error(
+        "Database error on %s %s", request.method, request.url.path, exc_info=exc
+    )
+    return ORJSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content={"detail": "Database error"},
+    )
+
+
 origins = os.getenv("CORS_ORIGIN", "*").split(",")
 
 app.add_middleware(
@@ -59,26 +79,48 @@ app.include_router(ai.router, prefix="/ai", tags=["AI Debugging"])
 
 @app.get("/")
 def root():
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_200_OK,
         content={"message": "Welcome to the real time Code Editor with AI support"},
     )
 
 
+# The schema is static for the life of the process, so it is rendered once
+_openapi_yaml = None
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)  # libyaml when available
+
+
 @app.get("/openapi.yaml")
 async def get_openapi_yaml():
-    openapi_json = get_openapi(
-        title="API Yaml file",
-        version="1.0.0",
-        description="This is an automatically generated OpenAPI schema .",
-        routes=app.routes,
-    )
-    openapi_yaml = yaml.dump(openapi_json, default_flow_style=False)
-    return openapi_yaml
+    global _openapi_yaml
+    if _openapi_yaml is None:
+        openapi_json = get_openapi(
+            title="API Yaml file",
+            version="1.0.0",
+            description="This is an automatically generated OpenAPI schema .",
+            routes=app.routes,
+        )
+        _openapi_yaml = yaml.dump(
+            openapi_json, Dumper=YamlDumper, default_flow_style=False
+        ).encode("utf-8")
+    return Response(content=_openapi_yaml, media_type="application/yaml")
 
 
 if __name__ == "__main__":
+    # Local development only. Production runs under Gunicorn with UvicornWorker
+    # processes (see DockerFile), which sizes the worker pool to the CPU count.
     import uvicorn
 
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # uvloop + httptools replace the default asyncio loop and h11 parser; the
+    # websockets protocol is pinned rather than left to auto-detection
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=True,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_per_message_deflate=False,  # see workers.py
+    )
@@ -0,0 +1,48 @@
+from sqlalchemy import and_, cast, exists, String, update
+from sqlalchemy.orm import aliased
+import logging
+
+from db import engine, Base
+from models import CodeFile
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# create_all only adds indexes together with new tables, so databases created
+# before an index was added to the models get it here. Run once before the app
+# workers start (see DockerFile), never from the workers themselves
+def rename_duplicate_titles(conn) -> int:
+    # The unique (user_id, title) index can't be built over duplicate titles. The
+    # oldest file keeps its title, later copies get their id appended
+    older = aliased(CodeFile)
+    result = conn.execute(
+        update(CodeFile)
+        .where(
+            exists().where(
+                and_(
+                    older.user_id == CodeFile.user_id,
+                    older.title == CodeFile.title,
+                    older.id < CodeFile.id,
+                )
+            )
+        )
+        .values(title=CodeFile.title + " (" + cast(CodeFile.id, String) + ")")
+    )
+    return result.rowcount
+
+
+def migrate():
+    Base.metadata.create_all(bind=engine)
+    # One transaction, so a failure leaves neither renamed titles nor half the indexes
+    with engine.begin() as conn:
+        renamed = rename_duplicate_titles(conn)
+        if renamed:
+            logger.info(f"Renamed {renamed} duplicate file titles")
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+
+if __name__ == "__main__":
+    migrate()
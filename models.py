@@ -1,6 +1,18 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime, TIMESTAMP
-from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    Text,
+    DateTime,
+    Index,
+    TIMESTAMP,
+    cast,
+    extract,
+)
+from sqlalchemy.orm import column_property, relationship
+from sqlalchemy.sql import false, func, text
 from db import Base
 import datetime
 
@@ -12,18 +24,41 @@ from sqlalchemy import (
 
 class User(Base):
     __tablename__ = "users"
+    # Admin rows only, so counting admins (delete_user) reads a few index pages
+    __table_args__ = (
+        Index(
+            "ix_users_admin",
+            "id",
+            postgresql_where=text("is_admin"),
+            sqlite_where=text("is_admin"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     hashed_password = Column(String)
-    is_admin = Column(Boolean, default=False)  # Added admin flag
+    # Never NULL, so it loads as a plain True/False and needs no bool() casts
+    is_admin = Column(Boolean, nullable=False, default=False, server_default=false())
     created_at = Column(TIMESTAMP, server_default=func.now())
+    # Epoch seconds computed by the database in the same SELECT, so responses use
+    # the int as-is. An expression rather than a stored column, no migration needed
+    created_at_ts = column_property(cast(extract("epoch", created_at), BigInteger))
 
-    files = relationship("CodeFile", back_populates="owner")
+    # Never loaded implicitly: a user's files can be large, and the async sessions
+    # can't lazy load anyway. Load with selectinload(User.files) where needed
+    files = relationship("CodeFile", back_populates="owner", lazy="raise")
 
 
 class CodeFile(Base):
     __tablename__ = "code_files"
+    # Titles are unique per user; the database enforces it in the same round trip.
+    # Its index also serves title lookups, (user_id, id) serves the paged listing.
+    # A named index rather than a table constraint, so main.py can add it to
+    # tables created before it existed
+    __table_args__ = (
+        Index("uq_code_files_user_id_title", "user_id", "title", unique=True),
+        Index("ix_code_files_user_id_id", "user_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(Text, nullable=False)
@@ -32,5 +67,5 @@ class CodeFile(Base):
     last_updated = Column(DateTime, default=datetime.datetime.now)
 
     owner = relationship(
-        "User", back_populates="files"
+        "User", back_populates="files", lazy="raise"
     )  # Ensure back_populates matches User.files
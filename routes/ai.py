@@ -1,18 +1,25 @@
-from fastapi.responses import JSONResponse
-from openai import OpenAI, RateLimitError
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from openai import AsyncOpenAI, RateLimitError
 from fastapi import APIRouter, Depends, HTTPException, status, Request, FastAPI
 import os
-from sqlalchemy.orm import Session
+from sqlalchemy import lambda_stmt, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
 from google import generativeai as genai
+from cachetools import TTLCache
 import logging
+import asyncio
+import hashlib
 import httpx
-import json
+import orjson
+import time
+from typing import Dict, List, Tuple
 
-from auth import get_db, get_current_user
+from auth import get_async_db, get_current_user
+from routes.lang_detect import detect_language
 from models import CodeFile
 
 
@@ -36,100 +43,168 @@ if not gemini_api_key:
 else:
     genai.configure(api_key=gemini_api_key)
 
+# Built once so the model config is reused across requests
+gemini_model = None
+if gemini_api_key:
+    gemini_model = genai.GenerativeModel("gemini-2.0-flash")
+
 
 openai_client = None
 if openai_api_key:
-    openai_client = OpenAI(api_key=openai_api_key)
+    # Single module-level client so the HTTP/2 connection pool is shared across requests
+    openai_client = AsyncOpenAI(
+        api_key=openai_api_key,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=50,
+                keepalive_expiry=30,
+            ),
+        ),
+    )
+
+OPENAI_MODEL = "gpt-4o-mini"
+MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", 40000))
+
+# Circuit breaker: after OpenAI reports a rate limit, skip it until this monotonic time
+OPENAI_COOLDOWN_SECONDS = 60
+_openai_blocked_until: float = 0.0
+
+# Gemini is only asked once OpenAI fails or runs past this delay (about its p95)
+AI_HEDGE_DELAY = float(os.getenv("AI_HEDGE_DELAY", 8.0))  # seconds
+
+# Concurrent identical prompts share one in-flight completion, keyed by the
+# prompt's digest. Entries are dropped as soon as the completion settles.
+# Prompts are never held back to form batches: a wait window delays every call,
+# and merging files into one prompt loses the per-language cacheable prefix
+_openai_inflight: Dict[bytes, Tuple[asyncio.Task, List[int]]] = {}
+
+# sha256 of the stripped code -> (suggestions, provider)
+suggestion_cache = TTLCache(maxsize=1024, ttl=3600)
 
 limiter = Limiter(
     key_func=get_remote_address,
     default_limits=["50/day", "5/minute"],
-    storage_uri="memory://",
+    storage_uri=os.getenv("REDIS_URL", "memory://"),
+    strategy="moving-window",
 )
 
 
-def detect_language(code: str) -> str:
-    """Detects if the code is Python or JavaScript based on common syntax patterns."""
-    python_indicators = [
-        "import ",
-        "def ",
-        "class ",
-        "print(",
-        "#",
-        "if __name__ ==",
-        "->",
-        ":",
-    ]
-    js_indicators = [
-        "function ",
-        "const ",
-        "let ",
-        "var ",
-        "=>",
-        "document.",
-        "console.log",
-        "export ",
-        "import {",
+# Static instructions go first and the code last, so every request for a language
+# shares an identical prompt prefix that the providers can cache
+JS_SYSTEM_PROMPT = """
+You are an expert JavaScript developer. Analyze the JavaScript code in the user's message and provide a structured debugging report.
+
+**Instructions:**
+1. **Syntax Errors:** Identify incorrect JavaScript syntax and provide corrected versions.
+2. **Logical Errors:** Detect mistakes in conditionals, loops, and function logic.
+3. **Performance Issues:** Suggest faster alternatives (e.g., reduce unnecessary loops).
+4. **Security Risks:** Check for vulnerabilities such as XSS, CSRF, or unsafe eval usage.
+5. **Modern JS Practices:** Suggest improvements using ES6+ features.
+6. **Edge Cases:** Identify where the code might fail.
+7. **Corrected Code & Explanation:** Provide fixes and explain why they are necessary.
+"""
+
+PY_SYSTEM_PROMPT = """
+You are an expert Python developer. Analyze the Python code in the user's message and provide a structured debugging report.
+
+**Instructions:**
+1. **Syntax Errors:** Identify Python syntax mistakes and provide corrected versions.
+2. **Logical Errors:** Detect issues in loops, conditionals, and function calls.
+3. **Performance Issues:** Suggest optimizations like list comprehensions or avoiding redundant loops.
+4. **Security Risks:** Check for SQL injection, unvalidated inputs, and unsafe file handling.
+5. **Pythonic Best Practices:** Suggest improvements based on PEP-8.
+6. **Edge Cases:** Identify scenarios where this code might fail.
+7. **Corrected Code & Explanation:** Provide fixes and explain why they are necessary.
+"""
+
+UNK_SYSTEM_PROMPT = """
+The code in the user's message has been submitted for debugging, but the programming language is unclear.
+
+**Instructions:**
+1. Try to **detect the possible programming language**.
+2. Identify any **syntax errors** and suggest fixes.
+3. Find **logical errors** and provide corrections.
+4. Suggest **best practices** for readability and maintainability.
+5. If you can, **recommend which language this code resembles most**.
+"""
+
+# language -> (system prompt, code fence tag)
+PROMPTS = {
+    "JavaScript": (JS_SYSTEM_PROMPT, "js"),
+    "Python": (PY_SYSTEM_PROMPT, "python"),
+    "Unknown": (UNK_SYSTEM_PROMPT, ""),
+}
+
+
+def build_prompt(language: str, code: str) -> Tuple[str, str]:
+    """Returns the (system, user) prompt pair, with only the user part varying."""
+    system_prompt, fence = PROMPTS.get(language, PROMPTS["Unknown"])
+    return system_prompt, f"```{fence}\n{code}\n```"
+
+
+def openai_messages(prompt: Tuple[str, str]) -> List[dict]:
+    system_prompt, code_message = prompt
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": code_message},
     ]
 
-    python_score = sum(1 for indicator in python_indicators if indicator in code)
-    js_score = sum(1 for indicator in js_indicators if indicator in code)
 
-    return (
-        "Python"
-        if python_score > js_score
-        else "JavaScript"
-        if js_score > python_score
-        else "Unknown"
+async def _create_openai_completion(prompt):
+    response = await openai_client.chat.completions.create(
+        model=OPENAI_MODEL, messages=openai_messages(prompt)
     )
+    return response.choices[0].message.content
 
 
-async def check_openai_limit():
-    """
-    Check if OpenAI rate limits are available before making a full request
-    Returns True if rate limits are available, False otherwise
-    """
-    if not openai_api_key:
-        return False
+async def _submit_openai_prompt(prompt):
+    """Join the in-flight completion for an identical prompt, or start one."""
+    key = hashlib.sha256("\0".join(prompt).encode("utf-8")).digest()
+    loop = asyncio.get_running_loop()
 
-    try:
-        # check if rate limits are available
-        # This consumes fewer tokens than a full completion request
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(
-                "https://api.openai.com/v1/models",
-                headers={"Authorization": f"Bearer {openai_api_key}"},
-            )
+    entry = _openai_inflight.get(key)
+    if entry is None or entry[0].get_loop() is not loop:
+        task = asyncio.create_task(_create_openai_completion(prompt))
+        entry = _openai_inflight[key] = (task, [0])
 
-            # If we get a 429, rate limits are exceeded
-            if response.status_code == 429:
-                logger.info("OpenAI rate limits exceeded, switching to Gemini")
-                return False
+        def forget(done_task, key=key):
+            current = _openai_inflight.get(key)
+            if current is not None and current[0] is done_task:
+                del _openai_inflight[key]
 
-            # Check for other error responses other tah 200
-            if response.status_code != 200:
-                logger.warning(
-                    f"OpenAI API returned status code {response.status_code}"
-                )
-                return False
+        task.add_done_callback(forget)
 
-            return True
-    except Exception as e:
-        logger.warning(f"Error checking OpenAI limits: {str(e)}")
-        return False
+    task, waiters = entry
+    waiters[0] += 1
+    try:
+        # Shielded so one caller giving up doesn't cancel the others' completion
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if waiters[0] == 1:
+            task.cancel()
+        raise
+    finally:
+        waiters[0] -= 1
 
 
 async def get_openai_response(prompt):
     """Get response from OpenAI API with error handling"""
+    global _openai_blocked_until
+
     if not openai_client:
         return None, "OpenAI API key not configured"
 
+    # Still cooling down from a previous rate limit, let the caller fall back
+    if time.monotonic() < _openai_blocked_until:
+        return None, "OpenAI rate limit cooldown"
+
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo", messages=[{"role": "system", "content": prompt}]
-        )
-        return response.choices[0].message.content, None
+        return await _submit_openai_prompt(prompt), None
     except RateLimitError:
+        _openai_blocked_until = time.monotonic() + OPENAI_COOLDOWN_SECONDS
+        logger.info("OpenAI rate limits exceeded, switching to Gemini")
         return None, "Rate limit exceeded"
     except Exception as e:
         return None, str(e)
@@ -137,124 +212,212 @@ async def get_openai_response(prompt):
 
 async def get_gemini_response(prompt):
     """Get response from Gemini API with error handling"""
-    if not gemini_api_key:
+    if not gemini_model:
         return None, "Gemini API key not configured"
 
     try:
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        response = model.generate_content(prompt)
+        response = await gemini_model.generate_content_async("\n".join(prompt))
         return response.text, None
     except Exception as e:
         return None, str(e)
 
 
+async def open_openai_stream(prompt):
+    """Start a streamed OpenAI completion, returning (chunk iterator, error)"""
+    global _openai_blocked_until
+
+    if not openai_client:
+        return None, "OpenAI API key not configured"
+
+    if time.monotonic() < _openai_blocked_until:
+        return None, "OpenAI rate limit cooldown"
+
+    try:
+        stream = await openai_client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=openai_messages(prompt),
+            stream=True,
+        )
+    except RateLimitError:
+        _openai_blocked_until = time.monotonic() + OPENAI_COOLDOWN_SECONDS
+        logger.info("OpenAI rate limits exceeded, switching to Gemini")
+        return None, "Rate limit exceeded"
+    except Exception as e:
+        return None, str(e)
+
+    async def chunks():
+        # Close the upstream response if the client goes away mid-stream, so the
+        # pooled connection is released instead of draining an unread generation
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+    return chunks(), None
+
+
+async def open_gemini_stream(prompt):
+    """Start a streamed Gemini completion, returning (chunk iterator, error)"""
+    if not gemini_model:
+        return None, "Gemini API key not configured"
+
+    try:
+        response = await gemini_model.generate_content_async(
+            "\n".join(prompt), stream=True
+        )
+    except Exception as e:
+        return None, str(e)
+
+    async def chunks():
+        async for chunk in response:
+            yield chunk.text
+
+    return chunks(), None
+
+
+def sse_event(data: str) -> str:
+    # JSON-encode each chunk so newlines in code can't break SSE framing
+    return f"data: {orjson.dumps(data).decode()}\n\n"
+
+
+def stream_suggestions(chunks, provider: str, cache_key: bytes = None):
+    """Relay provider chunks as server-sent events, caching the full text at the end"""
+    # Without a key to store under, the chunks were served from the cache
+    cache_status = "MISS" if cache_key is not None else "HIT"
+
+    async def relay():
+        parts = []
+        async for text in chunks:
+            parts.append(text)
+            yield sse_event(text)
+        yield "data: [DONE]\n\n"
+        if cache_key is not None and parts:
+            suggestion_cache[cache_key] = ("".join(parts), provider)
+
+    return StreamingResponse(
+        relay(),
+        media_type="text/event-stream",
+        headers={"X-AI-Provider": provider, "X-Cache": cache_status},
+    )
+
+
+async def _single_chunk(text: str):
+    yield text
+
+
+def analyze_code(content: str) -> Tuple[str, bytes]:
+    """Validates and strips the code once, returning it with its SHA-256 digest."""
+    # Refuse pathological inputs before any hashing, templating or LLM call
+    if len(content) > MAX_PROMPT_CHARS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="File too large for AI debug; split it up",
+        )
+
+    code_content = content.strip()
+    if not code_content:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Code file is empty"
+        )
+
+    return code_content, hashlib.sha256(code_content.encode("utf-8")).digest()
+
+
 @router.post("/debug/{file_id}")
 @limiter.limit("10/minute; 100/day")
 async def debug_code(
     request: Request,
     file_id: int,
-    db: Session = Depends(get_db),
+    stream: bool = False,
+    db: AsyncSession = Depends(get_async_db),
     user=Depends(get_current_user),
 ):
     # debugging for Python and JavaScript code.
-    code_file = db.query(CodeFile).filter(CodeFile.id == file_id).first()
-
-    if not code_file:
+    # With ?stream=true the report is sent as server-sent events while it is generated.
+    # Only the content column is needed, so skip building a CodeFile instance.
+    # lambda_stmt builds the statement once, file_id is bound per call
+    stmt = lambda_stmt(lambda: select(CodeFile.content).where(CodeFile.id == file_id))
+    result = await db.execute(stmt)
+    row = result.first()
+
+    if row is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="File not found"
         )
 
-    if not code_file.content.strip():
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Code file is empty"
+    code_content, cache_key = analyze_code(row.content or "")
+
+    # Identical code gets identical suggestions, so skip the providers on a cache hit.
+    # The language is derived from the code, so the digest alone is a complete key.
+    cached = suggestion_cache.get(cache_key)
+    if cached:
+        suggestions, ai_provider_used = cached
+        if stream:
+            return stream_suggestions(_single_chunk(suggestions), ai_provider_used)
+        return ORJSONResponse(
+            status_code=status.HTTP_200_OK,
+            content={
+                "file_id": file_id,
+                "suggestions": suggestions,
+                "ai_provider": ai_provider_used,
+            },
+            headers={"X-Cache": "HIT"},
         )
 
-    language = detect_language(code_file.content)
-    code_content = code_file.content.strip()
-
-    if language == "JavaScript":
-        prompt = f"""
-        You are an expert JavaScript developer. Analyze the following JavaScript code and provide a structured debugging report.
-
-        --- CODE ---
-        ```js
-        {code_content}
-        ```
-        ------------------
-        
-        **Instructions:**
-        1. **Syntax Errors:** Identify incorrect JavaScript syntax and provide corrected versions.
-        2. **Logical Errors:** Detect mistakes in conditionals, loops, and function logic.
-        3. **Performance Issues:** Suggest faster alternatives (e.g., reduce unnecessary loops).
-        4. **Security Risks:** Check for vulnerabilities such as XSS, CSRF, or unsafe eval usage.
-        5. **Modern JS Practices:** Suggest improvements using ES6+ features.
-        6. **Edge Cases:** Identify where the code might fail.
-        7. **Corrected Code & Explanation:** Provide fixes and explain why they are necessary.
-
-        **Now, analyze the JavaScript code and provide a structured debugging report.**
-        """
-
-    elif language == "Python":
-        prompt = f"""
-        You are an expert Python developer. Analyze the following Python code and provide a structured debugging report.
-
-        --- CODE ---
-        ```python
-        {code_content}
-        ```
-        ------------------
-        
-        **Instructions:**
-        1. **Syntax Errors:** Identify Python syntax mistakes and provide corrected versions.
-        2. **Logical Errors:** Detect issues in loops, conditionals, and function calls.
-        3. **Performance Issues:** Suggest optimizations like list comprehensions or avoiding redundant loops.
-        4. **Security Risks:** Check for SQL injection, unvalidated inputs, and unsafe file handling.
-        5. **Pythonic Best Practices:** Suggest improvements based on PEP-8.
-        6. **Edge Cases:** Identify scenarios where this code might fail.
-        7. **Corrected Code & Explanation:** Provide fixes and explain why they are necessary.
-
-        **Now, analyze the Python code and provide a structured debugging report.**
-        """
-
-    else:
-        prompt = f"""
-        The following code has been submitted for debugging, but the programming language is unclear.
-
-        --- CODE ---
-        ```
-        {code_content}
-        ```
-        ------------------
-        
-        **Instructions:**
-        1. Try to **detect the possible programming language**.
-        2. Identify any **syntax errors** and suggest fixes.
-        3. Find **logical errors** and provide corrections.
-        4. Suggest **best practices** for readability and maintainability.
-        5. If you can, **recommend which language this code resembles most**.
-
-        **Now, analyze the code and provide a debugging report.**
-        """
-
-    # Check if OpenAI has available rate limits
-    openai_available = await check_openai_limit()
-
-    if openai_available:
-        # Use OpenAI if rate limits are available
-        ai_provider_used = "OpenAI"
-        suggestions, error = await get_openai_response(prompt)
+    language = detect_language(code_content)
 
-        # If the request itself failed, try Gemini 2nd option
-        if not suggestions:
-            logger.info(
-                f"OpenAI request failed with error: {error}. Falling back to Gemini AI."
-            )
+    prompt = build_prompt(language, code_content)
+
+    if stream:
+        # Fallback only covers failures to start a stream; once bytes are sent
+        # the provider can't be switched
+        ai_provider_used = "OpenAI"
+        chunks, error = await open_openai_stream(prompt)
+        if chunks is None:
+            logger.info(f"OpenAI stream failed with error: {error}. Trying Gemini.")
             ai_provider_used = "Gemini"
-            suggestions, error = await get_gemini_response(prompt)
-    else:
-        # Use Gemini if OpenAI rate limits are not available
-        ai_provider_used = "Gemini"
-        suggestions, error = await get_gemini_response(prompt)
+            chunks, error = await open_gemini_stream(prompt)
+        if chunks is None:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error with all AI providers. Last error: {error}",
+            )
+        return stream_suggestions(chunks, ai_provider_used, cache_key)
+
+    # OpenAI goes first. Gemini is started as a hedge only if OpenAI fails, is
+    # cooling down, or hasn't answered within AI_HEDGE_DELAY, so the usual
+    # request costs a single completion
+    tasks = {asyncio.create_task(get_openai_response(prompt)): "OpenAI"}
+    pending = set(tasks)
+    hedged = False
+    suggestions, error, ai_provider_used = None, None, None
+
+    while pending and not suggestions:
+        done, pending = await asyncio.wait(
+            pending,
+            timeout=None if hedged else AI_HEDGE_DELAY,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        # Prefer OpenAI if both finished in the same iteration
+        for task in sorted(done, key=lambda t: tasks[t] != "OpenAI"):
+            result, task_error = task.result()
+            if result:
+                suggestions, ai_provider_used = result, tasks[task]
+                break
+            logger.info(f"{tasks[task]} request failed with error: {task_error}")
+            error = task_error
+
+        if not suggestions and not hedged:
+            hedged = True
+            gemini_task = asyncio.create_task(get_gemini_response(prompt))
+            tasks[gemini_task] = "Gemini"
+            pending.add(gemini_task)
+
+    # The slower provider's answer is no longer needed
+    for task in pending:
+        task.cancel()
 
     # If both services failed or rate limit exceeded
     if not suggestions:
@@ -263,13 +426,16 @@ async def debug_code(
             detail=f"Error with all AI providers. Last error: {error}",
         )
 
-    return JSONResponse(
+    suggestion_cache[cache_key] = (suggestions, ai_provider_used)
+
+    return ORJSONResponse(
         status_code=status.HTTP_200_OK,
         content={
             "file_id": file_id,
             "suggestions": suggestions,
             "ai_provider": ai_provider_used,
         },
+        headers={"X-Cache": "MISS"},
     )
 
 
@@ -280,7 +446,7 @@ def setup_rate_limiting(app: FastAPI):
 
     @app.exception_handler(RateLimitExceeded)
     async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             content={"error": "Too many requests. Please try again later."},
         )
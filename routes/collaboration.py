@@ -1,9 +1,12 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from typing import Dict, Set, Deque
+from typing import Dict, List, Optional, Set, Union
+import asyncio
 import logging
+import os
 import time
-import json
-from collections import deque
+import uuid
+import orjson
+import redis.asyncio as aioredis
 
 router = APIRouter()
 
@@ -13,21 +16,224 @@ active_connections: Dict[int, Set[WebSocket]] = {}
 # Updated notification connections - track which files each notification connection is interested in
 notification_connections: Dict[WebSocket, Set[int]] = {}
 
-message_history: Dict[int, Deque[float]] = {}
+# Reverse index of notification_connections - which connections are interested in each file
+file_subscribers: Dict[int, Set[WebSocket]] = {}
+
+# Outbound messages for each connection, drained by a dedicated relay task so a
+# slow client never blocks the sender or the rest of the broadcast
+outboxes: Dict[WebSocket, asyncio.Queue] = {}
+relay_tasks: Dict[WebSocket, asyncio.Task] = {}
+closing_tasks: Set[asyncio.Task] = set()
 
 MAX_MESSAGES = 10  # Maximum messages per time window
 TIME_WINDOW = 1.0  # Time window in seconds
+clock = time.monotonic  # Read through the module so tests can hold time still
+SEND_QUEUE_SIZE = 32  # Pending outbound messages before a client is dropped as too slow
+BROADCAST_BATCH_SIZE = 64  # Peers queued per event loop tick during a broadcast
+COALESCE_WINDOW = 0.01  # Seconds a batching client's relay waits to merge a burst
 logger = logging.getLogger("websockets")
 
+# With REDIS_URL set, room messages and notifications are also published to Redis
+# so connections held by other workers receive them. Each worker delivers to its
+# own connections directly and skips its own publishes when they come back.
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+WORKER_ID = uuid.uuid4().hex.encode()  # 32 bytes prefixed to every publish
+NOTIFICATION_CHANNEL = "notifications"
+pubsub: Optional[aioredis.client.PubSub] = None
+pubsub_task: Optional[asyncio.Task] = None
+fabric_tasks: Set[asyncio.Task] = set()
+
+
+class RateLimitState:
+    # Fixed-window message counter, held by the handler for the life of its connection
+    __slots__ = ("window_start", "count")
+
+    def __init__(self):
+        self.window_start = clock()
+        self.count = 0
+
+
+def is_rate_limited(state: RateLimitState) -> bool:
+    # Count messages in the current window, starting a new window once it expires
+    now = clock()
+    if now - state.window_start >= TIME_WINDOW:
+        state.window_start = now
+        state.count = 1
+        return False
+
+    state.count += 1
+    return state.count > MAX_MESSAGES
+
+
+async def receive_frame(websocket: WebSocket) -> Union[str, bytes]:
+    # Return the frame payload as sent: binary frames stay bytes and are never decoded
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message["code"], message.get("reason"))
+
+    data = message.get("bytes")
+    return data if data is not None else message["text"]
+
+
+def open_outbox(websocket: WebSocket, batch: bool = False):
+    # Helper function to start the send queue and relay task for a connection
+    queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    outboxes[websocket] = queue
+    relay_tasks[websocket] = asyncio.create_task(
+        relay_messages(websocket, queue, batch)
+    )
+
+
+async def relay_messages(websocket: WebSocket, queue: asyncio.Queue, batch: bool):
+    # Sole writer for a connection: drains its queue onto the socket in order
+    try:
+        while True:
+            message = await queue.get()
+
+            # Batching clients get each burst of text messages as one JSON array frame
+            if batch and isinstance(message, str):
+                await asyncio.sleep(COALESCE_WINDOW)
+                burst = [message]
+                message = None
+                while not queue.empty():
+                    queued = queue.get_nowait()
+                    if isinstance(queued, bytes):
+                        message = queued
+                        break
+                    burst.append(queued)
+
+                await websocket.send_text(orjson.dumps(burst).decode())
+                if message is None:
+                    continue
+
+            if isinstance(message, bytes):
+                await websocket.send_bytes(message)
+            else:
+                await websocket.send_text(message)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error relaying message to {id(websocket)}: {e}")
+
+
+def enqueue_message(websocket: WebSocket, message: Union[str, bytes]):
+    # Queue a message without waiting; a client whose queue is full is disconnected
+    queue = outboxes.get(websocket)
+    if queue is None:
+        return
+
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        logger.warning(f"Send queue full for connection {id(websocket)}, closing it")
+        close_outbox(websocket)
+        task = asyncio.create_task(websocket.close(code=1013))
+        closing_tasks.add(task)
+        task.add_done_callback(closing_tasks.discard)
+
+
+async def fan_out(peers: List[WebSocket], message: Union[str, bytes]):
+    # Queue a message for every peer, yielding to the event loop between batches
+    # so a large room can't stall other connections and requests
+    for start in range(0, len(peers), BROADCAST_BATCH_SIZE):
+        if start:
+            await asyncio.sleep(0)
+        for conn in peers[start : start + BROADCAST_BATCH_SIZE]:
+            enqueue_message(conn, message)
+
+
+def room_channel(file_id: int) -> str:
+    return f"room:{file_id}"
+
+
+def start_fabric():
+    # Helper function to start this worker's Redis listener on first use
+    global pubsub, pubsub_task
+    if redis_client is None or (pubsub_task and not pubsub_task.done()):
+        return
+
+    pubsub = redis_client.pubsub()
+    pubsub_task = asyncio.create_task(listen_to_fabric(pubsub))
+
+
+async def listen_to_fabric(listener: aioredis.client.PubSub):
+    # Relay messages published by other workers to this worker's connections
+    try:
+        await listener.subscribe(NOTIFICATION_CHANNEL)
+        async for message in listener.listen():
+            if message["type"] != "message":
+                continue
+
+            payload = message["data"]
+            if payload[:32] == WORKER_ID:
+                continue  # Already delivered locally by the publisher
+
+            channel = message["channel"].decode()
+            if channel == NOTIFICATION_CHANNEL:
+                header, body = payload[32:].split(b"\n", 1)
+                targets = notification_targets(orjson.loads(header))
+                await fan_out(targets, body.decode())
+            else:
+                file_id = int(channel.split(":", 1)[1])
+                kind, body = payload[32:33], payload[33:]
+                data = body if kind == b"b" else body.decode()
+                await fan_out(list(active_connections.get(file_id, ())), data)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Redis listener stopped: {e}", exc_info=True)
+
+
+async def publish(channel: str, payload: bytes):
+    # A Redis outage only costs cross-worker delivery, never the local connection
+    try:
+        await redis_client.publish(channel, WORKER_ID + payload)
+    except Exception as e:
+        logger.error(f"Error publishing to {channel}: {e}")
+
+
+async def join_room_channel(file_id: int):
+    # Subscribe to a room's channel when its first local connection arrives
+    if pubsub is None:
+        return
+
+    try:
+        await pubsub.subscribe(room_channel(file_id))
+    except Exception as e:
+        logger.error(f"Error subscribing to {room_channel(file_id)}: {e}")
+
+
+async def leave_room_channel(file_id: int):
+    # The room may have been rejoined while this was scheduled
+    if pubsub is None or file_id in active_connections:
+        return
+
+    try:
+        await pubsub.unsubscribe(room_channel(file_id))
+    except Exception as e:
+        logger.error(f"Error unsubscribing from {room_channel(file_id)}: {e}")
+
+
+def close_outbox(websocket: WebSocket):
+    # Helper function to stop the relay task and drop any queued messages
+    outboxes.pop(websocket, None)
+    task = relay_tasks.pop(websocket, None)
+    if task:
+        task.cancel()
+
 
 @router.websocket("/ws/{file_id}")
-async def websocket_endpoint(websocket: WebSocket, file_id: int):
+async def websocket_endpoint(websocket: WebSocket, file_id: int, batch: bool = False):
     await websocket.accept()
 
-    websocket_id = id(websocket)
-
-    active_connections.setdefault(file_id, set()).add(websocket)
-    message_history[websocket_id] = deque(maxlen=MAX_MESSAGES)
+    open_outbox(websocket, batch)
+    start_fabric()
+    room = active_connections.setdefault(file_id, set())
+    room.add(websocket)
+    if len(room) == 1:
+        await join_room_channel(file_id)
+    rate_state = RateLimitState()
 
     logger.info(f"New WebSocket Connection for file {file_id}.")
 
@@ -43,30 +249,33 @@ async def websocket_endpoint(websocket: WebSocket, file_id: int):
 
     try:
         while True:
-            data = await websocket.receive_text()
+            data = await receive_frame(websocket)
 
             # Check rate limiting
-            current_time = time.time()
-            message_history[websocket_id].append(current_time)
-
-            if (
-                len(message_history[websocket_id]) == MAX_MESSAGES
-                and current_time - message_history[websocket_id][0] < TIME_WINDOW
-            ):
+            if is_rate_limited(rate_state):
                 logger.warning(
-                    f"Rate limit exceeded for file {file_id}, connection {websocket_id}"
+                    f"Rate limit exceeded for file {file_id}, connection {id(websocket)}"
                 )
-                await websocket.send_text(
-                    "Error: Rate limit exceeded. Please slow down."
+                enqueue_message(
+                    websocket, "Error: Rate limit exceeded. Please slow down."
                 )
                 continue
 
             logger.info(f"Received data for file {file_id}: {data}")
 
-            if file_id in active_connections:
-                for conn in active_connections[file_id]:
-                    if conn != websocket:
-                        await conn.send_text(data)
+            # Snapshot the room so a slow-client disconnect can't mutate the set
+            peers = [
+                conn
+                for conn in active_connections.get(file_id, ())
+                if conn is not websocket
+            ]
+            await fan_out(peers, data)
+
+            if redis_client is not None:
+                if isinstance(data, bytes):
+                    await publish(room_channel(file_id), b"b" + data)
+                else:
+                    await publish(room_channel(file_id), b"t" + data.encode("utf-8"))
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected for file {file_id}")
 
@@ -90,13 +299,18 @@ async def websocket_endpoint(websocket: WebSocket, file_id: int):
 
 
 @router.websocket("/notifications/{file_id}")
-async def notifications_websocket(websocket: WebSocket, file_id: int):
+async def notifications_websocket(
+    websocket: WebSocket, file_id: int, batch: bool = False
+):
     await websocket.accept()
 
     websocket_id = id(websocket)
     # Initialize set of files this connection is interested in
+    open_outbox(websocket, batch)
+    start_fabric()
     notification_connections[websocket] = {file_id}
-    message_history[websocket_id] = deque(maxlen=MAX_MESSAGES)
+    file_subscribers.setdefault(file_id, set()).add(websocket)
+    rate_state = RateLimitState()
 
     logger.info(
         f"New notification WebSocket connection for file {file_id}: {websocket_id}"
@@ -104,30 +318,30 @@ async def notifications_websocket(websocket: WebSocket, file_id: int):
 
     try:
         while True:
-            data = await websocket.receive_text()
+            data = await receive_frame(websocket)
 
             # Check rate limiting
-            current_time = time.time()
-            message_history[websocket_id].append(current_time)
-
-            if (
-                len(message_history[websocket_id]) == MAX_MESSAGES
-                and current_time - message_history[websocket_id][0] < TIME_WINDOW
-            ):
+            if is_rate_limited(rate_state):
                 logger.warning(
                     f"Rate limit exceeded for notification connection {websocket_id}"
                 )
-                await websocket.send_text(
-                    "Error: Rate limit exceeded. Please slow down."
+                enqueue_message(
+                    websocket, "Error: Rate limit exceeded. Please slow down."
                 )
                 continue
 
             try:
-                notification_data = json.loads(data)
+                notification_data = orjson.loads(data)
                 logger.info(
                     f"Received notification for file {file_id}: {notification_data}"
                 )
 
+                # A subscribe message adds a file to this connection instead of
+                # being broadcast
+                if notification_data.get("type") == "subscribe":
+                    subscribe_connection(websocket, notification_data.get("file_id"))
+                    continue
+
                 # Add file_id to the notification data if not present
                 if "file_id" not in notification_data:
                     notification_data["file_id"] = file_id
@@ -138,10 +352,10 @@ async def notifications_websocket(websocket: WebSocket, file_id: int):
                     file_id=notification_data.get("file_id"),
                     exclude=websocket,
                 )
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 logger.warning(f"Invalid notification format: {data}")
-                await websocket.send_text(
-                    "Error: Invalid notification format. Must be valid JSON."
+                enqueue_message(
+                    websocket, "Error: Invalid notification format. Must be valid JSON."
                 )
 
     except WebSocketDisconnect:
@@ -159,33 +373,43 @@ async def notifications_websocket(websocket: WebSocket, file_id: int):
         )
 
 
-# Add a method to subscribe to additional files
+def subscribe_connection(websocket: WebSocket, file_id):
+    # Add a file to a notification connection and confirm it on the same socket
+    if not isinstance(file_id, int) or isinstance(file_id, bool):
+        enqueue_message(websocket, "Error: Subscribe needs an integer file_id.")
+        return
+
+    notification_connections[websocket].add(file_id)
+    file_subscribers.setdefault(file_id, set()).add(websocket)
+    enqueue_message(
+        websocket,
+        orjson.dumps(
+            {
+                "type": "subscription",
+                "file_id": file_id,
+                "status": "subscribed",
+                "message": f"Successfully subscribed to notifications for file {file_id}",
+            }
+        ).decode(),
+    )
+    logger.info(f"Connection {id(websocket)} subscribed to file {file_id}")
+
+
+# A separate socket can't name the notification connection it is meant for, so
+# subscriptions are sent as a message on that connection instead
 @router.websocket("/notifications/subscribe/{file_id}")
 async def subscribe_to_file(websocket: WebSocket, file_id: int):
     await websocket.accept()
-
-    if websocket in notification_connections:
-        notification_connections[websocket].add(file_id)
-        await websocket.send_text(
-            json.dumps(
-                {
-                    "type": "subscription",
-                    "file_id": file_id,
-                    "status": "subscribed",
-                    "message": f"Successfully subscribed to notifications for file {file_id}",
-                }
-            )
-        )
-        logger.info(f"Connection {id(websocket)} subscribed to file {file_id}")
-    else:
-        await websocket.send_text(
-            json.dumps(
-                {
-                    "type": "error",
-                    "message": "Not connected to notification system. Connect to /notifications/{file_id} first.",
-                }
-            )
-        )
+    await websocket.send_text(
+        orjson.dumps(
+            {
+                "type": "error",
+                "status": "unsupported",
+                "message": f'Send {{"type": "subscribe", "file_id": {file_id}}} '
+                "on your notification connection instead.",
+            }
+        ).decode()
+    )
     await websocket.close()
 
 
@@ -196,43 +420,51 @@ async def broadcast_notification(
     # - If file_id is provided, only send to clients interested in that file
     # - If file_id is None, send to all notification clients (for system-wide notifications)
 
-    if not notification_connections:
+    targets = notification_targets(file_id, exclude)
+    if not targets and redis_client is None:
         return
 
-    message = json.dumps(notification_data)
+    # Serialize once; every target's queue shares the same payload object.
+    # Decoded back to str so clients keep receiving text frames
+    message = orjson.dumps(notification_data)
+    if redis_client is not None:
+        await publish(NOTIFICATION_CHANNEL, orjson.dumps(file_id) + b"\n" + message)
+    await fan_out(targets, message.decode())
 
-    for conn, subscribed_files in notification_connections.items():
-        if conn == exclude:  # Don't send back to sender if specified
-            continue
 
-        # Only send if this is a system-wide notification (file_id is None)
-        # or if the connection is subscribed to this file_id
-        if file_id is None or file_id in subscribed_files:
-            try:
-                await conn.send_text(message)
-            except Exception as e:
-                logger.error(f"Error sending notification: {e}")
+def notification_targets(file_id: int = None, exclude: WebSocket = None):
+    # Only send if this is a system-wide notification (file_id is None)
+    # or if the connection is subscribed to this file_id.
+    # Don't send back to sender if specified
+    if file_id is None:
+        subscribers = notification_connections.keys()
+    else:
+        subscribers = file_subscribers.get(file_id, ())
+    return [conn for conn in subscribers if conn is not exclude]
 
 
 def cleanup_connection(websocket: WebSocket, file_id: int):
     # Helper function to clean up connection resource
-    websocket_id = id(websocket)
-
     if file_id in active_connections:
         active_connections[file_id].discard(websocket)
         if not active_connections[file_id]:
             del active_connections[file_id]
+            if pubsub is not None:
+                task = asyncio.create_task(leave_room_channel(file_id))
+                fabric_tasks.add(task)
+                task.add_done_callback(fabric_tasks.discard)
 
-    if websocket_id in message_history:
-        del message_history[websocket_id]
+    close_outbox(websocket)
 
 
 def cleanup_notification_connection(websocket: WebSocket):
     # Helper function to clean up notification connection resources
-    websocket_id = id(websocket)
-
     if websocket in notification_connections:
-        del notification_connections[websocket]
-
-    if websocket_id in message_history:
-        del message_history[websocket_id]
+        for file_id in notification_connections.pop(websocket):
+            subscribers = file_subscribers.get(file_id)
+            if subscribers is not None:
+                subscribers.discard(websocket)
+                if not subscribers:
+                    del file_subscribers[file_id]
+
+    close_outbox(websocket)
@@ -1,20 +1,50 @@
-from fastapi import APIRouter, Body, Depends, HTTPException, status
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from sqlalchemy.exc import SQLAlchemyError
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, status
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from sqlalchemy import case, delete, func, insert, lambda_stmt, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError
 from typing import List, Optional
 from pydantic import BaseModel, Field
-from auth import get_current_user, get_db
+from auth import (
+    get_async_db,
+    get_async_session_factory,
+    get_current_user,
+)
 from models import CodeFile
+import base64
+import logging
+import os
+import orjson
+import redis.asyncio as aioredis
 
 router = APIRouter()
 
+# Files with more content than this (in characters) are streamed by get_file
+# in chunks of this size instead of being loaded and serialized in one piece
+STREAM_CHUNK_SIZE = 65536
+
+# With REDIS_URL set, get_file and get_all_files responses are cached for
+# CACHE_TTL seconds. Each user's entries live in one hash keyed by their id, so
+# nothing is shared across users and any write by the user drops them in one DEL
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+CACHE_TTL = 30
+logger = logging.getLogger(__name__)
+
+BULK_MAX_FILES = 500  # Files accepted by one POST /files/bulk
+PAGE_MAX_FILES = 500  # Largest ?limit= accepted by GET /files/
+
 
 class FileContent(BaseModel):
     content: Optional[str] = Field(None, min_length=8)
     title: Optional[str] = Field(None, min_length=8)
 
 
+class FileCreate(BaseModel):
+    title: str
+    content: str = ""
+
+
 class FileResponse(BaseModel):
     id: int
     content: str
@@ -27,38 +57,148 @@ class FileListResponse(BaseModel):
 
 
 class PaginationParams(BaseModel):
-    skip: int = 0
-    limit: int = 100
+    cursor: Optional[str] = None
+    limit: int = Field(100, ge=1, le=PAGE_MAX_FILES)
+    include: Optional[str] = None
 
 
-@router.post("/")
-def create_file(
-    title: str = Body(..., embed=True),
-    db: Session = Depends(get_db),
-    user=Depends(get_current_user),
-):
-    # Validate title
+async def get_file_owner(db: AsyncSession, file_id: int) -> Optional[int]:
+    # Ownership probe, only run to tell "missing" from "not yours" after a write
+    # filtered on the owner matched nothing. lambda_stmt caches the built statement
+    stmt = lambda_stmt(lambda: select(CodeFile.user_id).where(CodeFile.id == file_id))
+    return (await db.execute(stmt)).scalar_one_or_none()
+
+
+def cache_key(user_id: int) -> str:
+    return f"files:{user_id}"
+
+
+async def get_cached(user_id: int, field: str) -> Optional[bytes]:
+    # A Redis outage is a cache miss, never a failed request
+    if redis_client is None:
+        return None
+    try:
+        return await redis_client.hget(cache_key(user_id), field)
+    except Exception as e:
+        logger.error(f"Error reading file cache: {e}")
+        return None
+
+
+async def set_cached(user_id: int, field: str, body: bytes):
+    if redis_client is None:
+        return
+    try:
+        # nx: later fills don't push the expiry back, so a stale entry can't
+        # outlive CACHE_TTL however often the hash is read and refilled
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(cache_key(user_id), field, body)
+            pipe.expire(cache_key(user_id), CACHE_TTL, nx=True)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Error writing file cache: {e}")
+
+
+async def invalidate_cache(user_id: int):
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(cache_key(user_id))
+    except Exception as e:
+        logger.error(f"Error clearing file cache: {e}")
+
+
+def cached_response(body: bytes) -> Response:
+    return Response(
+        content=body,
+        status_code=status.HTTP_200_OK,
+        media_type="application/json",
+        headers={"X-Cache": "HIT"},
+    )
+
+
+async def raise_missing_or_forbidden(db: AsyncSession, file_id: int, action: str):
+    # Helper function for the error once an owner-filtered statement matched no row
+    if await get_file_owner(db, file_id) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Code File not found"
+        )
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=f"Not authorized to {action} this file",
+    )
+
+
+# The payload checks below are declared as the first dependency of their route,
+# so a bad request is rejected before a session is opened or the user is loaded
+
+
+async def valid_title(title: str = Body(..., embed=True)) -> str:
     if not title.strip():
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Title cannot be empty.",
         )
+    return title
 
-    # Check if the title already exists for the user
-    existing_file = db.query(CodeFile).filter_by(user_id=user.id, title=title).first()
-    if existing_file:
+
+async def valid_files(files: List[FileCreate] = Body(...)) -> List[FileCreate]:
+    if not files:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Title must be unique for the user.",
+            detail="At least one file must be provided.",
+        )
+
+    if len(files) > BULK_MAX_FILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {BULK_MAX_FILES} files can be created at once.",
+        )
+
+    if any(not file.title.strip() for file in files):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Title cannot be empty.",
+        )
+    return files
+
+
+async def valid_update(file_data: FileContent) -> FileContent:
+    # Ensure at least one of title or content is provided
+    if not file_data.title and not file_data.content:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="At least one of 'title' or 'content' must be provided.",
+        )
+
+    if file_data.title and not file_data.title.strip():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Title cannot be empty.",
         )
+    return file_data
+
 
+@router.post("/")
+async def create_file(
+    title: str = Depends(valid_title),
+    db: AsyncSession = Depends(get_async_db),
+    user=Depends(get_current_user),
+):
     try:
-        new_file = CodeFile(user_id=user.id, title=title, content="")
-        db.add(new_file)
-        db.commit()
-        db.refresh(new_file)
+        # RETURNING hands back the generated id with the insert, no reload needed
+        new_file = (
+            await db.execute(
+                insert(CodeFile)
+                .values(user_id=user.id, title=title, content="")
+                .returning(
+                    CodeFile.id, CodeFile.title, CodeFile.content, CodeFile.user_id
+                )
+            )
+        ).one()
+        await db.commit()
+        await invalidate_cache(user.id)
 
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_201_CREATED,
             content={
                 "newFile": {
@@ -70,73 +210,90 @@ def create_file(
                 "message": "Code File successfully created",
             },
         )
-    except SQLAlchemyError as e:
-        db.rollback()
+    except IntegrityError:
+        # The (user_id, title) unique constraint rejected a duplicate title
+        await db.rollback()
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Title must be unique for the user.",
         )
 
 
-@router.put("/{file_id}")
-def update_file(
-    file_id: int,
-    file_data: FileContent,
-    db: Session = Depends(get_db),
+@router.post("/bulk")
+async def create_files(
+    files: List[FileCreate] = Depends(valid_files),
+    db: AsyncSession = Depends(get_async_db),
     user=Depends(get_current_user),
 ):
+    # Create many files (e.g. a project import) in one INSERT and one transaction
     try:
-        file = db.query(CodeFile).filter(CodeFile.id == file_id).first()
-
-        if not file:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail="Code File not found"
-            )
-
-        if file.user_id != user.id:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authorized to update this file",
-            )
-
-        # Ensure at least one of title or content is provided
-        if not file_data.title and not file_data.content:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="At least one of 'title' or 'content' must be provided.",
+        rows = [
+            {"user_id": user.id, "title": file.title, "content": file.content}
+            for file in files
+        ]
+        # A duplicate title, against existing files or within the batch, fails
+        # the whole statement so nothing is half imported
+        new_files = (
+            await db.execute(
+                insert(CodeFile)
+                .values(rows)
+                .returning(CodeFile.id, CodeFile.title, CodeFile.user_id)
             )
+        ).all()
+        await db.commit()
+        await invalidate_cache(user.id)
 
-        # Check if title is provided and validate uniqueness
-        if file_data.title:
-            if not file_data.title.strip():
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Title cannot be empty.",
-                )
+        return ORJSONResponse(
+            status_code=status.HTTP_201_CREATED,
+            content={
+                "newFiles": [file._asdict() for file in new_files],
+                "message": "Code Files successfully created",
+            },
+        )
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Title must be unique for the user.",
+        )
 
-            existing_file = (
-                db.query(CodeFile)
-                .filter(CodeFile.user_id == user.id, CodeFile.title == file_data.title)
-                .filter(CodeFile.id != file_id)  # Exclude the current file
-                .first()
-            )
 
-            if existing_file:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Title must be unique for the user.",
-                )
+@router.put("/{file_id}")
+async def update_file(
+    file_id: int,
+    file_data: FileContent = Depends(valid_update),
+    db: AsyncSession = Depends(get_async_db),
+    user=Depends(get_current_user),
+):
+    try:
+        values = {}
 
-            file.title = file_data.title  # Update title
+        # Update title if provided, uniqueness is enforced by the database
+        if file_data.title:
+            values["title"] = file_data.title
 
         # Update content if provided
         if file_data.content:
-            file.content = file_data.content
+            values["content"] = file_data.content
+
+        # Ownership check and write in one statement, returning the updated row
+        file = (
+            await db.execute(
+                update(CodeFile)
+                .where(CodeFile.id == file_id, CodeFile.user_id == user.id)
+                .values(**values)
+                .returning(
+                    CodeFile.id, CodeFile.title, CodeFile.content, CodeFile.user_id
+                )
+            )
+        ).first()
+        if file is None:
+            await raise_missing_or_forbidden(db, file_id, "update")
 
-        db.commit()
-        db.refresh(file)
+        await db.commit()
+        await invalidate_cache(user.id)
 
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_200_OK,
             content={
                 "file": {
@@ -148,133 +305,208 @@ def update_file(
                 "message": "Code File successfully updated",
             },
         )
-    except SQLAlchemyError as e:
-        db.rollback()
+    except IntegrityError:
+        await db.rollback()
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Title must be unique for the user.",
         )
 
 
 @router.get("/{file_id}")
-def get_file(
+async def get_file(
     file_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     user=Depends(get_current_user),
+    session_factory=Depends(get_async_session_factory),
 ):
-    try:
-        file = db.query(CodeFile).filter(CodeFile.id == file_id).first()
-
-        if not file:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail="Code File not found"
-            )
+    cache_field = f"file:{file_id}"
+    cached = await get_cached(user.id, cache_field)
+    if cached:
+        return cached_response(cached)
+
+    # Content is only selected here when it is small, large files are streamed.
+    # lambda_stmt builds the statement once, file_id is bound per call
+    stmt = lambda_stmt(
+        lambda: select(
+            CodeFile.user_id,
+            func.length(CodeFile.content).label("size"),
+            case(
+                (func.length(CodeFile.content) <= STREAM_CHUNK_SIZE, CodeFile.content)
+            ).label("content"),
+        ).where(CodeFile.id == file_id)
+    )
+    file = (await db.execute(stmt)).first()
+
+    if not file:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Code File not found"
+        )
 
-        if file.user_id != user.id:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Not authorized to access this file",
-            )
+    if file.user_id != user.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to access this file",
+        )
 
-        return JSONResponse(
+    if file.size is not None and file.size > STREAM_CHUNK_SIZE:
+        return StreamingResponse(
+            stream_file(session_factory, file_id, file.user_id),
             status_code=status.HTTP_200_OK,
-            content={
-                "file": {
-                    "id": file.id,
-                    "content": file.content,
-                    "user_id": file.user_id,
-                },
-                "message": "Code File fetched successfully",
-            },
+            media_type="application/json",
         )
-    except SQLAlchemyError as e:
+
+    response = ORJSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={
+            "file": {
+                "id": file_id,
+                "content": file.content,
+                "user_id": file.user_id,
+            },
+            "message": "Code File fetched successfully",
+        },
+        headers={"X-Cache": "MISS"},
+    )
+    await set_cached(user.id, cache_field, response.body)
+    return response
+
+
+async def stream_file(session_factory, file_id: int, user_id: int):
+    # Emits the same JSON as the small-file response, with content read and
+    # escaped one substring at a time. The request session may already be closed
+    # while the body is sent, so the chunks are read on a session of our own.
+    # All chunks come from one snapshot, a concurrent PUT can't be spliced in
+    yield f'{{"file":{{"id":{file_id},"content":"'.encode()
+    async with session_factory() as db:
+        if db.bind.dialect.name == "sqlite":
+            # The driver only opens transactions for writes, start the read one
+            await (await db.connection()).exec_driver_sql("BEGIN")
+        else:
+            await db.connection(
+                execution_options={"isolation_level": "REPEATABLE READ"}
+            )
+        offset = 1  # substr() is 1-based
+        while True:
+            chunk = (
+                await db.execute(
+                    select(
+                        func.substr(CodeFile.content, offset, STREAM_CHUNK_SIZE)
+                    ).where(CodeFile.id == file_id)
+                )
+            ).scalar()
+            if not chunk:
+                break
+            yield orjson.dumps(chunk)[1:-1]  # escaped, without the quotes
+            offset += STREAM_CHUNK_SIZE
+    yield f'","user_id":{user_id}}},"message":"Code File fetched successfully"}}'.encode()
+
+
+def encode_cursor(file_id: int) -> str:
+    return base64.urlsafe_b64encode(str(file_id).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
         )
 
 
 @router.get("/")
-def get_all_files(
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def get_all_files(
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=PAGE_MAX_FILES),
+    include: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
     user=Depends(get_current_user),
 ):
-    # pagination suppotred
-    try:
-        query = db.query(CodeFile).filter(CodeFile.user_id == user.id)
-        total_count = query.count()
-
-        files = query.offset(skip).limit(limit).all()
-
-        if not files:
-            return JSONResponse(
-                status_code=status.HTTP_200_OK,
-                content={
-                    "files": [],
-                    "total": 0,
-                    "skip": skip,
-                    "limit": limit,
-                    "message": "No code files found",
-                },
-            )
+    # Keyset pagination: a page continues after the last id of the previous page
+    # (passed back as `cursor`), so no rows are skipped over and nothing is counted
+    after_id = decode_cursor(cursor) if cursor else 0
+
+    # The listing is id and title only, content can be large so it is only
+    # read from the database when asked for with ?include=content
+    with_content = include == "content"
+    columns = [CodeFile.id, CodeFile.title]
+    if with_content:
+        columns.append(CodeFile.content)
+
+    cache_field = f"list:{after_id}:{limit}:{int(with_content)}"
+    cached = await get_cached(user.id, cache_field)
+    if cached:
+        return cached_response(cached)
+
+    # Only the listed columns are loaded, no CodeFile instances are built.
+    # One extra row tells whether another page follows
+    files = (
+        await db.execute(
+            select(*columns)
+            .where(CodeFile.user_id == user.id, CodeFile.id > after_id)
+            .order_by(CodeFile.id)
+            .limit(limit + 1)
+        )
+    ).all()
 
-        file_list = [
-            {"id": file.id, "content": file.content, "title": file.title}
-            for file in files
-        ]
-        return JSONResponse(
+    if not files:
+        response = ORJSONResponse(
+            status_code=status.HTTP_200_OK,
+            content={
+                "files": [],
+                "next_cursor": None,
+                "limit": limit,
+                "message": "No code files found",
+            },
+            headers={"X-Cache": "MISS"},
+        )
+    else:
+        next_cursor = None
+        if len(files) > limit:
+            files = files[:limit]
+            next_cursor = encode_cursor(files[-1].id)
+
+        file_list = [file._asdict() for file in files]
+        response = ORJSONResponse(
             status_code=status.HTTP_200_OK,
             content={
                 "files": file_list,
-                "total": total_count,
-                "skip": skip,
+                "next_cursor": next_cursor,
                 "limit": limit,
                 "message": "Files fetched successfully",
             },
-        )
-    except SQLAlchemyError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
+            headers={"X-Cache": "MISS"},
         )
 
+    await set_cached(user.id, cache_field, response.body)
+    return response
+
 
 @router.delete("/{file_id}")
-def delete_file(
+async def delete_file(
     file_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     user=Depends(get_current_user),
 ):
     # Delete a specific file if owned by the authenticated user.
-    try:
-        file = db.query(CodeFile).filter(CodeFile.id == file_id).first()
-
-        if not file:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail="Code File not found"
-            )
-
-        if file.user_id != user.id:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authorized to delete this file",
-            )
-
-        db.delete(file)
-        db.commit()
-
-        return JSONResponse(
-            status_code=status.HTTP_200_OK,
-            content={
-                "id": file_id,
-                "message": "Code File successfully deleted",
-            },
-        )
-    except SQLAlchemyError as e:
-        db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
+    deleted = (
+        await db.execute(
+            delete(CodeFile)
+            .where(CodeFile.id == file_id, CodeFile.user_id == user.id)
+            .returning(CodeFile.id)
         )
+    ).first()
+    if deleted is None:
+        await raise_missing_or_forbidden(db, file_id, "delete")
+
+    await db.commit()
+    await invalidate_cache(user.id)
+
+    return ORJSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={
+            "id": file_id,
+            "message": "Code File successfully deleted",
+        },
+    )
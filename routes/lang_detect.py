@@ -0,0 +1,58 @@
+# Plain string heuristics with no SDK imports, routes.ai uses detect_language
+import re
+
+
+PYTHON_INDICATORS = [
+    "import ",
+    "def ",
+    "class ",
+    "print(",
+    "#",
+    "if __name__ ==",
+    "->",
+    ":",
+]
+JS_INDICATORS = [
+    "function ",
+    "const ",
+    "let ",
+    "var ",
+    "=>",
+    "document.",
+    "console.log",
+    "export ",
+    "import {",
+]
+
+# One compiled alternation per language so detection is a single scan over the code
+_PYTHON_RE = re.compile("|".join(map(re.escape, PYTHON_INDICATORS)))
+_JS_RE = re.compile("|".join(map(re.escape, JS_INDICATORS)))
+
+
+def _count_indicators(pattern: re.Pattern, code: str, total: int, stop_at: int) -> int:
+    """Counts distinct indicators matched, stopping once `stop_at` is reached."""
+    seen = set()
+    for match in pattern.finditer(code):
+        seen.add(match.group())
+        if len(seen) >= stop_at or len(seen) == total:
+            break
+    return len(seen)
+
+
+def detect_language(code: str) -> str:
+    """Detects if the code is Python or JavaScript based on common syntax patterns."""
+    # Score is the number of distinct indicators present, not their occurrences
+    js_score = _count_indicators(_JS_RE, code, len(JS_INDICATORS), len(JS_INDICATORS))
+
+    # Python wins as soon as it passes the JS score, no need to scan the rest
+    python_score = _count_indicators(
+        _PYTHON_RE, code, len(PYTHON_INDICATORS), js_score + 1
+    )
+
+    return (
+        "Python"
+        if python_score > js_score
+        else "JavaScript"
+        if js_score > python_score
+        else "Unknown"
+    )
@@ -1,23 +1,91 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from sqlalchemy.exc import SQLAlchemyError
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import delete, exists, func, insert, or_, select, update
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError
 from typing import Optional
 from pydantic import BaseModel, Field
-from auth import get_db, get_current_user
-from models import User
+from auth import get_async_db, get_current_user
+from models import CodeFile, User
+from routes.files import invalidate_cache
 from auth import (
-    get_password_hash,
-    verify_password,
+    get_password_hash_async,
+    verify_and_update_password_async,
     create_access_token,
+    user_claims,
     ACCESS_TOKEN_EXPIRE_MINUTES,
+    SECRET_KEY,
 )
 from fastapi.security import OAuth2PasswordRequestForm
-from datetime import datetime, timedelta
+from datetime import timedelta
+from slowapi import Limiter
+from slowapi.util import get_remote_address
+from cachetools import TTLCache
+import hashlib
+import hmac
+import os
 
 
 router = APIRouter()
 
+# Every login or signup attempt costs a password hash, so the endpoints that take a
+# password are limited per client IP before any hashing happens
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=os.getenv("REDIS_URL", "memory://"),
+    strategy="moving-window",
+)
+PASSWORD_RATE_LIMIT = "10/minute"
+
+# Credentials verified in the last minute -> (user id, password hash they matched).
+# Keys are keyed hashes, the password itself is never held. A later password
+# or username change makes the stored hash or name differ, so the entry is ignored
+verified_logins: TTLCache = TTLCache(maxsize=4096, ttl=60)
+
+
+def login_cache_key(username: str, password: str) -> bytes:
+    message = username.encode() + b"|" + password.encode()
+    return hmac.new(SECRET_KEY.encode(), message, hashlib.blake2b).digest()[:16]
+
+
+async def get_verified_login(
+    db: AsyncSession, key: bytes, username: str
+) -> Optional[User]:
+    cached = verified_logins.get(key)
+    if cached is None:
+        return None
+
+    user_id, hashed_password = cached
+    user = await db.get(User, user_id)
+    if (
+        user is None
+        or user.username != username
+        or user.hashed_password != hashed_password
+    ):
+        verified_logins.pop(key, None)
+        return None
+    return user
+
+
+async def username_taken(db: AsyncSession, username: str) -> bool:
+    # Probe on the username index that fetches an id at most, no User is built
+    stmt = select(User.id).where(User.username == username)
+    return (await db.execute(stmt)).scalar() is not None
+
+
+async def write_user(db: AsyncSession, stmt, detail: str):
+    # Runs an INSERT/UPDATE ... RETURNING on users and commits, returning the row.
+    # The unique index on username is what actually settles a race between two
+    # requests for the same name, username_taken only fails the common case early
+    try:
+        row = (await db.execute(stmt)).first()
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+    return row
+
 
 class UserCreate(BaseModel):
     username: str = Field(..., min_length=3, max_length=50)
@@ -39,293 +107,314 @@ class UserResponse(BaseModel):
 
 
 @router.post("/register")
-def register(user_data: UserCreate, db: Session = Depends(get_db)):
+@limiter.limit(PASSWORD_RATE_LIMIT)
+async def register(
+    request: Request, user_data: UserCreate, db: AsyncSession = Depends(get_async_db)
+):
     # Register a new regular (non-admin) user.
-    try:
-        existing_user = (
-            db.query(User).filter(User.username == user_data.username).first()
+    if await username_taken(db, user_data.username):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username already registered",
         )
-        if existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Username already registered",
-            )
 
-        new_user = User(
+    new_user = await write_user(
+        db,
+        insert(User)
+        .values(
             username=user_data.username,
-            hashed_password=get_password_hash(user_data.password),
+            hashed_password=await get_password_hash_async(user_data.password),
             is_admin=False,  # Force all registered users to be non-admin
         )
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
-
-        return JSONResponse(
-            status_code=status.HTTP_201_CREATED,
-            content={
-                "message": "User created successfully",
-                "user_id": new_user.id,
-                "username": new_user.username,
-            },
-        )
-    except SQLAlchemyError as e:
-        db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
-        )
+        .returning(User.id, User.username),
+        "Username already registered",
+    )
+
+    return ORJSONResponse(
+        status_code=status.HTTP_201_CREATED,
+        content={
+            "message": "User created successfully",
+            "user_id": new_user.id,
+            "username": new_user.username,
+        },
+    )
 
 
 @router.post("/signup-admin")
-def create_admin_user(
+async def create_admin_user(
     user_data: UserCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user),
 ):
     # Allow an authenticated admin to create new users with admin privileges.
-    try:
-        if not current_user.is_admin:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Only admins can create new users with admin privileges",
-            )
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only admins can create new users with admin privileges",
+        )
 
-        existing_user = (
-            db.query(User).filter(User.username == user_data.username).first()
+    if await username_taken(db, user_data.username):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username already registered",
         )
-        if existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Username already registered",
-            )
 
-        new_user = User(
+    new_user = await write_user(
+        db,
+        insert(User)
+        .values(
             username=user_data.username,
-            hashed_password=get_password_hash(user_data.password),
+            hashed_password=await get_password_hash_async(user_data.password),
             is_admin=user_data.is_admin,
         )
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
-
-        return JSONResponse(
-            status_code=status.HTTP_201_CREATED,
-            content={
-                "message": "User created successfully",
-                "user_id": new_user.id,
-                "username": new_user.username,
-                "is_admin": new_user.is_admin,
-            },
-        )
-    except SQLAlchemyError as e:
-        db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
-        )
+        .returning(User.id, User.username, User.is_admin),
+        "Username already registered",
+    )
+
+    return ORJSONResponse(
+        status_code=status.HTTP_201_CREATED,
+        content={
+            "message": "User created successfully",
+            "user_id": new_user.id,
+            "username": new_user.username,
+            "is_admin": new_user.is_admin,
+        },
+    )
 
 
 @router.post("/login")
-def login(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
+@limiter.limit(PASSWORD_RATE_LIMIT)
+async def login(
+    request: Request,
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    try:
-        user = db.query(User).filter(User.username == form_data.username).first()
-
-        if not user or not verify_password(form_data.password, user.hashed_password):
+    # A repeat of recently verified credentials skips the password hash
+    cache_key = login_cache_key(form_data.username, form_data.password)
+    user = await get_verified_login(db, cache_key, form_data.username)
+
+    if user is None:
+        user = (
+            await db.execute(select(User).where(User.username == form_data.username))
+        ).scalar_one_or_none()
+
+        verified, new_hash = False, None
+        if user:
+            # Password hashing is CPU-bound, keep it off the event loop
+            verified, new_hash = await verify_and_update_password_async(
+                form_data.password, user.hashed_password
+            )
+        if not verified:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid username or password",
             )
 
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": user.username}, expires_delta=access_token_expires
-        )
+        # Move hashes from before the switch to argon2id over as users log in
+        if new_hash:
+            user.hashed_password = new_hash
+            await db.commit()
 
-        # Convert datetime to timestamp
-        created_at_timestamp = (
-            int(user.created_at.timestamp())
-            if isinstance(user.created_at, datetime)
-            else user.created_at
-        )
+        verified_logins[cache_key] = (user.id, user.hashed_password)
 
-        user_data = {
-            "id": user.id,
-            "username": user.username,
-            "is_admin": bool(user.is_admin),  # Ensure proper boolean conversion
-            "created_at": created_at_timestamp,
-        }
-
-        return JSONResponse(
-            status_code=status.HTTP_200_OK,
-            content={
-                "access_token": access_token,
-                "token_type": "bearer",
-                "message": "User logged in successfully",
-                "user": user_data,
-            },
-        )
-    except SQLAlchemyError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
-        )
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data=user_claims(user), expires_delta=access_token_expires
+    )
+
+    user_data = {
+        "id": user.id,
+        "username": user.username,
+        "is_admin": user.is_admin,
+        "created_at": user.created_at_ts,
+    }
+
+    return ORJSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={
+            "access_token": access_token,
+            "token_type": "bearer",
+            "message": "User logged in successfully",
+            "user": user_data,
+        },
+    )
 
 
 @router.put("/users/{user_id}")
-def update_user(
+async def update_user(
     user_id: int,
     user_data: UserUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user),
 ):
-    try:
-        user_to_update = db.query(User).filter(User.id == user_id).first()
-
-        if not user_to_update:
+    # Check permissions: must be admin or the user themselves
+    is_current_user_admin = current_user.is_admin
+    if not is_current_user_admin and current_user.id != user_id:
+        if await db.get(User, user_id) is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
             )
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to update this user",
+        )
 
-        # Check permissions: must be admin or the user themselves
-        is_current_user_admin = bool(current_user.is_admin)
-        if not is_current_user_admin and current_user.id != user_id:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Not authorized to update this user",
-            )
+    # Only admins can change admin status
+    if user_data.is_admin is not None and not is_current_user_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only admins can change admin status",
+        )
 
-        # Only admins can change admin status
-        if user_data.is_admin is not None and not is_current_user_admin:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Only admins can change admin status",
-            )
+    changes = {}
+    stmt = update(User).where(User.id == user_id)
 
-        # Update username if provided
-        if user_data.username is not None:
-            # Check if username is already taken by someone else
-            existing_user = (
-                db.query(User).filter(User.username == user_data.username).first()
-            )
-            if existing_user is not None and existing_user.id != user_id:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Username already taken",
-                )
-            user_to_update.username = user_data.username
-
-        # Update password if provided
-        if user_data.password is not None:
-            user_to_update.hashed_password = get_password_hash(user_data.password)
-
-        # Update admin status if provided and current user is admin
-        if user_data.is_admin is not None and is_current_user_admin:
-            user_to_update.is_admin = user_data.is_admin
-
-        db.commit()
-        db.refresh(user_to_update)
-
-        return JSONResponse(
-            status_code=status.HTTP_200_OK,
-            content={
-                "message": "User updated successfully",
-                "user": {
-                    "id": user_to_update.id,
-                    "username": user_to_update.username,
-                    "is_admin": bool(user_to_update.is_admin),
-                },
-            },
+    # Update username if provided
+    if user_data.username is not None:
+        # The statement only matches while no one else has the name, so the
+        # check and the write are a single round trip
+        other = aliased(User)
+        stmt = stmt.where(
+            ~exists().where(other.username == user_data.username, other.id != user_id)
+        )
+        changes["username"] = user_data.username
+
+    # Update password if provided
+    if user_data.password is not None:
+        changes["hashed_password"] = await get_password_hash_async(user_data.password)
+
+    # Update admin status if provided and current user is admin
+    if user_data.is_admin is not None and is_current_user_admin:
+        changes["is_admin"] = user_data.is_admin
+
+    # The user is written and read back in one statement, never loaded first
+    columns = (User.id, User.username, User.is_admin)
+    if changes:
+        updated_user = await write_user(
+            db, stmt.values(**changes).returning(*columns), "Username already taken"
         )
-    except SQLAlchemyError as e:
-        db.rollback()
+    else:
+        updated_user = (
+            await db.execute(select(*columns).where(User.id == user_id))
+        ).first()
+
+    if updated_user is None:
+        # Nothing matched, either the user is gone or the name is taken
+        if user_data.username is not None and await db.get(User, user_id):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Username already taken",
+            )
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
         )
 
+    return ORJSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={
+            "message": "User updated successfully",
+            "user": {
+                "id": updated_user.id,
+                "username": updated_user.username,
+                "is_admin": updated_user.is_admin,
+            },
+        },
+    )
+
 
 @router.delete("/users/{user_id}")
-def delete_user(
+async def delete_user(
     user_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user),
 ):
     """Delete a user. Users can delete themselves, admins can delete any user."""
-    try:
-        user_to_delete = db.query(User).filter(User.id == user_id).first()
-
-        if not user_to_delete:
+    is_current_user_admin = current_user.is_admin
+    if not is_current_user_admin and current_user.id != user_id:
+        if await db.get(User, user_id) is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
             )
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to delete this user",
+        )
 
-        is_current_user_admin = bool(current_user.is_admin)
-        if not is_current_user_admin and current_user.id != user_id:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Not authorized to delete this user",
+    # The user's files are kept with no owner, as the ORM delete used to leave them
+    await db.execute(
+        update(CodeFile).where(CodeFile.user_id == user_id).values(user_id=None)
+    )
+
+    # Prevent deletion of the last admin. The admin count is checked by the DELETE
+    # itself (from the partial admin index), so two admins can't remove each other
+    admin_count = (
+        select(func.count()).select_from(User).where(User.is_admin)
+    ).scalar_subquery()
+    deleted = (
+        await db.execute(
+            delete(User)
+            .where(
+                User.id == user_id,
+                # IS NOT TRUE rather than NOT, so rows from before is_admin was
+                # NOT NULL (where it can still be NULL) count as non-admins
+                or_(User.is_admin.is_not(True), admin_count > 1),
             )
-
-        # Prevent deletion of the last admin
-        if user_to_delete.is_admin:
-            admin_count = db.query(User).filter(User.is_admin == True).count()
-            if admin_count <= 1:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Cannot delete the last admin user",
-                )
-
-        db.delete(user_to_delete)
-        db.commit()
-
-        return JSONResponse(
-            status_code=status.HTTP_200_OK,
-            content={"message": "User deleted successfully", "user_id": user_id},
+            .returning(User.id)
         )
-    except SQLAlchemyError as e:
-        db.rollback()
+    ).first()
+
+    if deleted is None:
+        await db.rollback()
+        if await db.get(User, user_id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
+            )
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cannot delete the last admin user",
         )
 
+    await db.commit()
+    # SQLite can hand the id to the next user, who mustn't see these cached files
+    await invalidate_cache(user_id)
+
+    return ORJSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={"message": "User deleted successfully", "user_id": user_id},
+    )
+
 
 @router.post("/initial-admin")
-def create_initial_admin(user_data: UserCreate, db: Session = Depends(get_db)):
+async def create_initial_admin(
+    user_data: UserCreate, db: AsyncSession = Depends(get_async_db)
+):
     # Create the first admin user when the system is empty.Only works if no users exist in the database.
 
-    try:
-        user_count = db.query(User).count()
-        if user_count > 0:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Initial admin can only be created when no users exist",
-            )
+    # EXISTS stops at the first row instead of counting the whole table
+    if await db.scalar(select(exists().select_from(User))):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Initial admin can only be created when no users exist",
+        )
 
-        hashed_password = get_password_hash(user_data.password)
-        new_admin = User(
+    hashed_password = await get_password_hash_async(user_data.password)
+    new_admin = await write_user(
+        db,
+        insert(User)
+        .values(
             username=user_data.username,
             hashed_password=hashed_password,
             is_admin=True,  # Force admin status
         )
-
-        db.add(new_admin)
-        db.commit()
-        db.refresh(new_admin)
-
-        return JSONResponse(
-            status_code=status.HTTP_201_CREATED,
-            content={
-                "message": "Initial admin user created successfully",
-                "user_id": new_admin.id,
-                "username": new_admin.username,
-            },
-        )
-    except SQLAlchemyError as e:
-        db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database error: {str(e)}",
-        )
+        .returning(User.id, User.username),
+        "Username already registered",
+    )
+
+    return ORJSONResponse(
+        status_code=status.HTTP_201_CREATED,
+        content={
+            "message": "Initial admin user created successfully",
+            "user_id": new_admin.id,
+            "username": new_admin.username,
+        },
+    )
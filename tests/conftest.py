@@ -1,51 +1,174 @@
-import sys
 import os
-
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import httpx
+import orjson
 import pytest
-from sqlalchemy import create_engine
+import pytest_asyncio
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from models import Base
-from auth import get_db
+from auth import get_db, get_async_db, get_async_session_factory, pwd_context
+from db import to_async_url
 from main import app
+from tests.helpers import UserCtx, auth_headers, create_test_user
 from fastapi.testclient import TestClient
 
 
-TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
-if not TEST_DATABASE_URL:
-    raise ValueError("TEST_DATABASE_URL is not set in the environment variables")
+# Without TEST_DATABASE_URL the tests run on an in-memory SQLite database. Shared
+# cache lets the sync engine and the API's async engine open it as the same
+# database, and the StaticPool connection keeps it alive for the whole run
+MEMORY_DATABASE_URL = "sqlite:///file:testdb?mode=memory&cache=shared&uri=true"
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL") or MEMORY_DATABASE_URL
 
+# Under pytest-xdist each worker process already gets its own in-memory database.
+# A SQLite file given in TEST_DATABASE_URL is split the same way, one per worker
+xdist_worker = os.getenv("PYTEST_XDIST_WORKER")
+if xdist_worker and TEST_DATABASE_URL != MEMORY_DATABASE_URL:
+    url = make_url(TEST_DATABASE_URL)
+    if url.get_backend_name() == "sqlite" and url.database:
+        root, ext = os.path.splitext(url.database)
+        TEST_DATABASE_URL = url.set(
+            database=f"{root}_{xdist_worker}{ext}"
+        ).render_as_string(hide_password=False)
 
-engine = create_engine(TEST_DATABASE_URL)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if TEST_DATABASE_URL == MEMORY_DATABASE_URL:
+    engine = create_engine(
+        TEST_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+else:
+    engine = create_engine(TEST_DATABASE_URL)
+# Test code reads back the ids and fields it just wrote, keeping them loaded past
+# the commit saves a SELECT per object
+TestingSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+)
+async_engine = create_async_engine(to_async_url(TEST_DATABASE_URL))
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Test data doesn't need to survive a crash, so skip syncing and keep the
+    # rollback journal in memory. Shared-cache readers skip table read locks,
+    # otherwise an open test session would block the API's writes
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=MEMORY")
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA read_uncommitted=true")
+    cursor.close()
+
+
+if TEST_DATABASE_URL.startswith("sqlite"):
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+AsyncTestingSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
+# Tests only need hashes that round-trip, not ones that resist cracking. Every
+# hash and login in the run uses argon2id at its smallest memory and time cost
+pwd_context.update(argon2__memory_cost=8, argon2__time_cost=1)
+
+
+def clear_tables(*tables):
+    """Deletes every row of the given tables, all tables when none are given"""
+    with engine.begin() as connection:
+        for table in tables or reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
 
 
-# Override FastAPI's database dependency
 @pytest.fixture(scope="session")
-def db_session():
-    """Provides a fresh test database session"""
+def test_database():
+    """Creates the schema once for the whole run"""
     Base.metadata.drop_all(bind=engine)  # Clear previous data before tests
     Base.metadata.create_all(bind=engine)  # Create tables
+    yield
+    Base.metadata.drop_all(bind=engine)  # Cleanup after tests
 
+
+@pytest.fixture
+def db_session(test_database):
+    """Provides a test database session, emptied again after each test"""
     session = TestingSessionLocal()
     yield session
     session.close()
 
-    Base.metadata.drop_all(bind=engine)  # Cleanup after tests
+    # The API runs on its own (async) connections and must see what a test
+    # commits, so tests can't be wrapped in a rolled back transaction. Deleting
+    # the rows is still far cheaper than recreating the schema per test
+    clear_tables()
+
 
+@pytest.fixture
+def user_ctx(db_session):
+    """Creates a user and returns it along with its cached auth headers"""
 
+    def make_user(username, password="testpass", is_admin=False):
+        user = create_test_user(db_session, username, password, is_admin=is_admin)
+        return UserCtx(user, auth_headers(username))
+
+    return make_user
+
+
+# Override FastAPI's database dependency
 @pytest.fixture(scope="session")
-def override_get_db(db_session):
+def override_get_db(test_database):
     """Dependency override to use test DB session in API"""
 
     def _get_db():
-        yield db_session
+        db = TestingSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def _get_async_db():
+        async with AsyncTestingSessionLocal() as db:
+            yield db
 
     app.dependency_overrides[get_db] = _get_db
+    app.dependency_overrides[get_async_db] = _get_async_db
+    app.dependency_overrides[get_async_session_factory] = (
+        lambda: AsyncTestingSessionLocal
+    )
+    yield
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_async_db, None)
+    app.dependency_overrides.pop(get_async_session_factory, None)
+
 
+@pytest.fixture(scope="session", autouse=True)
+def orjson_responses():
+    """Decodes test response bodies with orjson, the API encodes them with it too"""
+    stdlib_json = httpx.Response.json
 
-@pytest.fixture(scope="module")
+    def response_json(response, **kwargs):
+        if kwargs:  # json.loads options, orjson takes none
+            return stdlib_json(response, **kwargs)
+        return orjson.loads(response.content)
+
+    # TestClient responses are httpx responses as well
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(httpx.Response, "json", response_json)
+        yield
+
+
+@pytest.fixture(scope="session")
 def client(override_get_db):
     """Provides a TestClient instance for API testing"""
+    # Started once and shared by every module, app startup runs a single time.
+    # Every request and websocket also runs on this client's one event loop
     with TestClient(app) as c:
-        yield c  # Test client is available for the test module
+        yield c
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def async_client(override_get_db):
+    """Provides an AsyncClient calling the app in-process for HTTP tests"""
+    # Requests go straight to the ASGI app, no TestClient thread in between.
+    # Tests using it run on the session event loop
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
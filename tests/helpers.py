@@ -0,0 +1,46 @@
+from collections import namedtuple
+from datetime import timedelta
+from functools import lru_cache
+
+from sqlalchemy.orm import Session
+
+from auth import create_access_token, get_password_hash
+from models import User
+
+
+# Tokens name the user only by username and outlive the run, so one signed token,
+# and one header dict around it, serves every test using that username. Callers
+# must not modify the returned dict
+@lru_cache(maxsize=None)
+def get_auth_token(username):
+    return create_access_token(
+        data={"sub": username}, expires_delta=timedelta(minutes=30)
+    )
+
+
+@lru_cache(maxsize=None)
+def auth_headers(username):
+    return {"Authorization": f"Bearer {get_auth_token(username)}"}
+
+
+# Test-only shortcut: argon2 is deliberately slow, and the tests reuse a handful
+# of passwords, so each one is hashed once per run
+@lru_cache(maxsize=None)
+def hash_password(password):
+    return get_password_hash(password)
+
+
+# Utility to create a test user
+def create_test_user(db: Session, username, password, is_admin=False):
+    user = User(
+        username=username,
+        hashed_password=hash_password(password),
+        is_admin=is_admin,
+    )
+    db.add(user)
+    db.commit()
+    return user
+
+
+# A created user together with the headers that authenticate as them
+UserCtx = namedtuple("UserCtx", ["user", "headers"])
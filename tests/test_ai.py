@@ -1,29 +1,53 @@
-import sys
-import os
-
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import asyncio
+import json
 import pytest
-from unittest.mock import patch, MagicMock, AsyncMock
-from fastapi.testclient import TestClient
-from fastapi import status
-from sqlalchemy.orm import Session
-from httpx import Response
+import pytest_asyncio
+from pathlib import Path
+from unittest.mock import MagicMock, AsyncMock
+from fastapi import HTTPException, status
+import httpx
+from openai import AsyncOpenAI
 from main import app
-from routes.ai import detect_language
+import routes.ai as ai
+from auth import get_current_user
+from routes.ai import (
+    MAX_PROMPT_CHARS,
+    analyze_code,
+    build_prompt,
+    sse_event,
+    stream_suggestions,
+    suggestion_cache,
+)
+from routes.lang_detect import detect_language
 from models import CodeFile
 
-client = TestClient(app)
-
 
 # Mock user authentication
 def mock_get_current_user():
     return {"id": 1, "username": "test_user"}
 
 
-# Mock database session
-@pytest.fixture
-def mock_db_session():
-    return MagicMock(spec=Session)
+@pytest.fixture(scope="module")
+def auth_client(async_client):
+    """Async client whose requests are authenticated as the mock user"""
+    # Installed once for the module rather than around every test
+    app.dependency_overrides[get_current_user] = mock_get_current_user
+    yield async_client
+    app.dependency_overrides.pop(get_current_user, None)
+
+
+@pytest.fixture(autouse=True)
+def clear_suggestion_cache():
+    """Keep cached suggestions from leaking between tests"""
+    suggestion_cache.clear()
+    yield
+    suggestion_cache.clear()
+
+
+def add_code_file(db_session, file_id, content):
+    """Stores a code file in the test database for the endpoint to read"""
+    db_session.add(CodeFile(id=file_id, title=f"file {file_id}", content=content))
+    db_session.commit()
 
 
 # Mock responses for OpenAI and Gemini
@@ -42,6 +66,8 @@ TEST_CODE_UNKNOWN = "<html><body>Hello</body></html>"
         (TEST_CODE_PYTHON, "Python"),
         (TEST_CODE_JS, "JavaScript"),
         (TEST_CODE_UNKNOWN, "Unknown"),
+        # Repeated indicators count once, so many "#" lines don't outweigh JS syntax
+        ("# a\n# b\n# c\nconst x = () => 1;", "JavaScript"),
     ],
 )
 def test_detect_language(code, expected_language):
@@ -49,275 +75,290 @@ def test_detect_language(code, expected_language):
     assert detect_language(code) == expected_language
 
 
-# Mock for OpenAI availability check
-@pytest.fixture
-def mock_openai_available():
-    """Mock for OpenAI rate limit check returning True (available)"""
-    return AsyncMock(return_value=True)
+def test_analyze_code_strips_and_hashes():
+    """Test surrounding whitespace doesn't change the cache digest"""
+    code, digest = analyze_code("\n  " + TEST_CODE_PYTHON + "  \n")
+    assert code == TEST_CODE_PYTHON
+    assert digest == analyze_code(TEST_CODE_PYTHON)[1]
 
 
-@pytest.fixture
-def mock_openai_unavailable():
-    """Mock for OpenAI rate limit check returning False (unavailable)"""
-    return AsyncMock(return_value=False)
+@pytest.mark.parametrize(
+    "content, expected_status",
+    [
+        ("   \n\t", status.HTTP_400_BAD_REQUEST),
+        ("x" * (MAX_PROMPT_CHARS + 1), status.HTTP_413_REQUEST_ENTITY_TOO_LARGE),
+    ],
+)
+def test_analyze_code_rejects_invalid(content, expected_status):
+    """Test empty and oversize files are rejected before any AI call"""
+    with pytest.raises(HTTPException) as exc_info:
+        analyze_code(content)
+    assert exc_info.value.status_code == expected_status
 
 
-# Mock for OpenAI response
-@pytest.fixture
-def mock_openai_success():
-    """Mock for successful OpenAI response"""
-    return AsyncMock(return_value=(mock_openai_response, None))
+def test_build_prompt_keeps_static_prefix():
+    """Test the code only appears in the user part, after the shared instructions"""
+    first = build_prompt("Python", TEST_CODE_PYTHON)
+    second = build_prompt("Python", "print('other')")
+    assert first[0] == second[0]
+    assert TEST_CODE_PYTHON not in first[0]
+    assert first[1] == f"```python\n{TEST_CODE_PYTHON}\n```"
 
 
-@pytest.fixture
-def mock_openai_failure():
-    """Mock for failed OpenAI response"""
-    return AsyncMock(return_value=(None, "OpenAI API error"))
+AI_RESPONSES = Path(__file__).parent / "fixtures" / "ai_responses"
 
 
-# Mock for Gemini response
-@pytest.fixture
-def mock_gemini_success():
-    """Mock for successful Gemini response"""
-    return AsyncMock(return_value=(mock_gemini_response, None))
+@pytest_asyncio.fixture
+async def openai_client_for():
+    """Builds real OpenAI clients whose HTTP requests are answered by a handler"""
+    clients = []
 
+    def build(handler):
+        client = AsyncOpenAI(
+            api_key="test",
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        )
+        clients.append(client)
+        return client
 
-@pytest.fixture
-def mock_gemini_failure():
-    """Mock for failed Gemini response"""
-    return AsyncMock(return_value=(None, "Gemini API error"))
+    yield build
 
+    for client in clients:
+        await client.close()
 
-@pytest.mark.asyncio
-@patch("routes.ai.check_openai_limit")
-@patch("routes.ai.get_openai_response")
-@patch("routes.ai.get_current_user", side_effect=mock_get_current_user)
-async def test_debug_code_with_openai(
-    mock_get_user,
-    mock_openai_response,
-    mock_check_openai,
-    mock_db_session,
-    mock_openai_available,
-    mock_openai_success,
-):
-    """Test debugging API using OpenAI when it's available"""
-    mock_check_openai.return_value = mock_openai_available.return_value
-    mock_openai_response.return_value = mock_openai_success.return_value
 
-    # Mock database response
-    mock_db_session.query().filter().first.return_value = CodeFile(
-        id=1, content=TEST_CODE_PYTHON
-    )
+def recorded_response(name):
+    """Provider response saved under fixtures/ai_responses"""
+    recorded = json.loads((AI_RESPONSES / f"{name}.json").read_text())
+    return httpx.Response(recorded["status_code"], json=recorded["json"])
 
-    response = client.post("/ai/debug/1", headers={"Authorization": "Bearer testtoken"})
-    assert response.status_code == status.HTTP_200_OK
-    assert mock_openai_response.return_value == response.json()["suggestions"]
-    assert "OpenAI" == response.json()["ai_provider"]
 
+# (result, error) pairs returned by the provider helpers
+OPENAI_SUCCESS = (mock_openai_response, None)
+OPENAI_FAILURE = (None, "OpenAI API error")
+OPENAI_COOLDOWN = (None, "OpenAI rate limit cooldown")
+GEMINI_SUCCESS = (mock_gemini_response, None)
+GEMINI_FAILURE = (None, "Gemini API error")
 
-@pytest.mark.asyncio
-@patch("routes.ai.check_openai_limit")
-@patch("routes.ai.get_gemini_response")
-@patch("routes.ai.get_current_user", side_effect=mock_get_current_user)
-async def test_debug_code_with_gemini_when_openai_unavailable(
-    mock_get_user,
-    mock_gemini_response,
-    mock_check_openai,
-    mock_db_session,
-    mock_openai_unavailable,
-    mock_gemini_success,
+
+@pytest.mark.asyncio(loop_scope="session")
+@pytest.mark.parametrize(
+    "code, openai_result, gemini_result, expected_status, expected_provider",
+    [
+        # OpenAI answers when it's available
+        (TEST_CODE_PYTHON, OPENAI_SUCCESS, GEMINI_FAILURE, 200, "OpenAI"),
+        (TEST_CODE_JS, OPENAI_SUCCESS, GEMINI_FAILURE, 200, "OpenAI"),
+        # Gemini answers while OpenAI cools down from a rate limit, or fails
+        (TEST_CODE_PYTHON, OPENAI_COOLDOWN, GEMINI_SUCCESS, 200, "Gemini"),
+        (TEST_CODE_PYTHON, OPENAI_FAILURE, GEMINI_SUCCESS, 200, "Gemini"),
+        # Nothing usable from either provider
+        (TEST_CODE_PYTHON, OPENAI_FAILURE, GEMINI_FAILURE, 500, None),
+    ],
+)
+async def test_debug_code(
+    monkeypatch,
+    db_session,
+    auth_client,
+    code,
+    openai_result,
+    gemini_result,
+    expected_status,
+    expected_provider,
 ):
-    """Test debugging API using Gemini when OpenAI is unavailable"""
-    mock_check_openai.return_value = mock_openai_unavailable.return_value
-    mock_gemini_response.return_value = mock_gemini_success.return_value
+    """Test which provider's report the debugging API returns"""
+    add_code_file(db_session, 1, code)
 
-    # Mock database response
-    mock_db_session.query().filter().first.return_value = CodeFile(
-        id=1, content=TEST_CODE_PYTHON
+    gemini = AsyncMock(return_value=gemini_result)
+    monkeypatch.setattr(
+        ai, "get_openai_response", AsyncMock(return_value=openai_result)
     )
-
-    response = client.post("/ai/debug/1", headers={"Authorization": "Bearer testtoken"})
-    assert response.status_code == status.HTTP_200_OK
-    assert mock_gemini_response.return_value[0] == response.json()["suggestions"]
-    assert "Gemini" == response.json()["ai_provider"]
-
-
-@pytest.mark.asyncio
-@patch("routes.ai.check_openai_limit")
-@patch("routes.ai.get_openai_response")
-@patch("routes.ai.get_gemini_response")
-@patch("routes.ai.get_current_user", side_effect=mock_get_current_user)
-async def test_debug_code_fallback_to_gemini(
-    mock_get_user,
-    mock_gemini_response,
-    mock_openai_response,
-    mock_check_openai,
-    mock_db_session,
-    mock_openai_available,
-    mock_openai_failure,
-    mock_gemini_success,
-):
-    """Test debugging API fallback to Gemini when OpenAI fails"""
-    mock_check_openai.return_value = mock_openai_available.return_value
-    mock_openai_response.return_value = mock_openai_failure.return_value
-    mock_gemini_response.return_value = mock_gemini_success.return_value
-
-    # Mock database response
-    mock_db_session.query().filter().first.return_value = CodeFile(
-        id=1, content=TEST_CODE_PYTHON
+    monkeypatch.setattr(ai, "get_gemini_response", gemini)
+    response = await auth_client.post(
+        "/ai/debug/1", headers={"Authorization": "Bearer testtoken"}
     )
 
-    response = client.post("/ai/debug/1", headers={"Authorization": "Bearer testtoken"})
-    assert response.status_code == status.HTTP_200_OK
-    assert mock_gemini_response.return_value[0] == response.json()["suggestions"]
-    assert "Gemini" == response.json()["ai_provider"]
-
-
-@pytest.mark.asyncio
-@patch("routes.ai.check_openai_limit")
-@patch("routes.ai.get_openai_response")
-@patch("routes.ai.get_gemini_response")
-@patch("routes.ai.get_current_user", side_effect=mock_get_current_user)
-async def test_debug_code_all_providers_fail(
-    mock_get_user,
-    mock_gemini_response,
-    mock_openai_response,
-    mock_check_openai,
-    mock_db_session,
-    mock_openai_available,
-    mock_openai_failure,
-    mock_gemini_failure,
-):
-    """Test error handling when both OpenAI and Gemini fail"""
-    mock_check_openai.return_value = mock_openai_available.return_value
-    mock_openai_response.return_value = mock_openai_failure.return_value
-    mock_gemini_response.return_value = mock_gemini_failure.return_value
-
-    # Mock database response
-    mock_db_session.query().filter().first.return_value = CodeFile(
-        id=1, content=TEST_CODE_PYTHON
+    assert response.status_code == expected_status
+    if expected_provider is None:
+        assert "Error with all AI providers" in response.json()["detail"]
+    else:
+        result = openai_result if expected_provider == "OpenAI" else gemini_result
+        assert response.json()["suggestions"] == result[0]
+        assert response.json()["ai_provider"] == expected_provider
+
+    # Gemini is only asked when OpenAI can't answer
+    assert gemini.await_count == (openai_result[0] is None)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_debug_code_hedges_slow_openai(monkeypatch, db_session, auth_client):
+    """Test Gemini is asked once OpenAI runs past the hedge delay"""
+    add_code_file(db_session, 1, TEST_CODE_PYTHON)
+    openai_cancelled = asyncio.Event()
+
+    async def slow_openai(prompt):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            openai_cancelled.set()
+            raise
+
+    monkeypatch.setattr(ai, "AI_HEDGE_DELAY", 0.01)
+    monkeypatch.setattr(ai, "get_openai_response", slow_openai)
+    monkeypatch.setattr(
+        ai, "get_gemini_response", AsyncMock(return_value=GEMINI_SUCCESS)
     )
-
-    response = client.post("/ai/debug/1", headers={"Authorization": "Bearer testtoken"})
-    assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
-    assert "Error with all AI providers" in response.json()["detail"]
-
-
-@pytest.mark.asyncio
-@patch("routes.ai.check_openai_limit")
-@patch("routes.ai.get_openai_response")
-@patch("routes.ai.get_current_user", side_effect=mock_get_current_user)
-async def test_debug_code_javascript(
-    mock_get_user,
-    mock_openai_response,
-    mock_check_openai,
-    mock_db_session,
-    mock_openai_available,
-    mock_openai_success,
-):
-    """Test debugging API for JavaScript code"""
-    mock_check_openai.return_value = mock_openai_available.return_value
-    mock_openai_response.return_value = mock_openai_success.return_value
-
-    # Mock database response
-    mock_db_session.query().filter().first.return_value = CodeFile(
-        id=2, content=TEST_CODE_JS
+    response = await auth_client.post(
+        "/ai/debug/1", headers={"Authorization": "Bearer testtoken"}
     )
 
-    response = client.post("/ai/debug/2", headers={"Authorization": "Bearer testtoken"})
-    assert response.status_code == status.HTTP_200_OK
-    assert mock_openai_response.return_value[0] == response.json()["suggestions"]
-    assert "OpenAI" == response.json()["ai_provider"]
+    assert response.status_code == 200
+    assert response.json()["ai_provider"] == "Gemini"
+    # The losing OpenAI call is cancelled rather than left running
+    await asyncio.wait_for(openai_cancelled.wait(), timeout=1)
 
 
-@pytest.mark.asyncio
-@patch("routes.ai.get_current_user", side_effect=mock_get_current_user)
-async def test_debug_code_file_not_found(mock_get_user, mock_db_session):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_debug_code_file_not_found(db_session, auth_client):
     """Test error handling when file is not found"""
-    # Mock database response
-    mock_db_session.query().filter().first.return_value = None
-
-    response = client.post(
+    response = await auth_client.post(
         "/ai/debug/99", headers={"Authorization": "Bearer testtoken"}
     )
     assert response.status_code == status.HTTP_404_NOT_FOUND
     assert response.json()["detail"] == "File not found"
 
 
-@pytest.mark.asyncio
-@patch("routes.ai.get_current_user", side_effect=mock_get_current_user)
-async def test_debug_code_empty_file(mock_get_user, mock_db_session):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_debug_code_empty_file(db_session, auth_client):
     """Test handling of an empty code file"""
-    # Mock database response
-    mock_db_session.query().filter().first.return_value = CodeFile(id=3, content="")
+    add_code_file(db_session, 3, "")
 
-    response = client.post("/ai/debug/3", headers={"Authorization": "Bearer testtoken"})
+    response = await auth_client.post(
+        "/ai/debug/3", headers={"Authorization": "Bearer testtoken"}
+    )
     assert response.status_code == status.HTTP_400_BAD_REQUEST
     assert response.json()["detail"] == "Code file is empty"
 
 
 @pytest.mark.asyncio
-@patch("httpx.AsyncClient.get")
-async def test_check_openai_limit_success(mock_httpx_get):
-    """Test successful OpenAI rate limit check"""
-    # Mock httpx response for successful API call
-    mock_response = MagicMock(spec=Response)
-    mock_response.status_code = 200
-    mock_httpx_get.return_value = mock_response
+async def test_openai_cooldown_after_rate_limit(monkeypatch, openai_client_for):
+    """Test OpenAI is skipped for the cooldown window after a rate limit"""
+    requests = []
+
+    def rate_limited(request):
+        requests.append(request)
+        return recorded_response("openai_rate_limit")
 
-    from routes.ai import check_openai_limit
+    monkeypatch.setattr(ai, "openai_client", openai_client_for(rate_limited))
+    monkeypatch.setattr(ai, "_openai_blocked_until", 0.0)
+    result, error = await ai.get_openai_response(("system", "prompt"))
+    assert result is None
+    assert error == "Rate limit exceeded"
 
-    result = await check_openai_limit()
-    assert result is True
+    # The second call must not reach the API while cooling down
+    result, error = await ai.get_openai_response(("system", "prompt"))
+    assert result is None
+    assert error == "OpenAI rate limit cooldown"
+    assert len(requests) == 1
 
 
 @pytest.mark.asyncio
-@patch("httpx.AsyncClient.get")
-async def test_check_openai_limit_rate_limited(mock_httpx_get):
-    """Test OpenAI rate limit exceeded detection"""
-    # Mock httpx response for rate limit exceeded
-    mock_response = MagicMock(spec=Response)
-    mock_response.status_code = 429
-    mock_httpx_get.return_value = mock_response
+async def test_openai_success_outside_cooldown(monkeypatch, openai_client_for):
+    """Test OpenAI is called normally when no cooldown is active"""
+    client = openai_client_for(lambda request: recorded_response("openai_completion"))
+    monkeypatch.setattr(ai, "openai_client", client)
+    monkeypatch.setattr(ai, "_openai_blocked_until", 0.0)
+    result, error = await ai.get_openai_response(("system", "prompt"))
+    assert result == mock_openai_response
+    assert error is None
 
-    from routes.ai import check_openai_limit
 
-    result = await check_openai_limit()
-    assert result is False
+@pytest.mark.asyncio
+async def test_openai_dedupes_identical_prompts(monkeypatch, openai_client_for):
+    """Test concurrent identical prompts share a single OpenAI completion"""
+    requests = []
+
+    def completed(request):
+        requests.append(request)
+        return recorded_response("openai_completion")
+
+    monkeypatch.setattr(ai, "openai_client", openai_client_for(completed))
+    monkeypatch.setattr(ai, "_openai_blocked_until", 0.0)
+    results = await asyncio.gather(
+        *(ai.get_openai_response(("system", "same prompt")) for _ in range(5)),
+        ai.get_openai_response(("system", "other prompt")),
+    )
+
+    assert all(result == (mock_openai_response, None) for result in results)
+    assert len(requests) == 2
+    # Settled completions aren't reused by later requests
+    assert not ai._openai_inflight
 
 
 @pytest.mark.asyncio
-@patch("httpx.AsyncClient.get")
-async def test_check_openai_limit_error(mock_httpx_get):
-    """Test OpenAI API error handling"""
-    # Mock httpx response for other API error
-    mock_response = MagicMock(spec=Response)
-    mock_response.status_code = 500
-    mock_httpx_get.return_value = mock_response
+async def test_openai_stream_yields_chunks(monkeypatch):
+    """Test streamed OpenAI deltas are relayed in order, skipping empty ones"""
+    fake_chunks = []
+    for text in ["Open", None, "AI"]:
+        chunk = MagicMock()
+        chunk.choices[0].delta.content = text
+        fake_chunks.append(chunk)
 
-    from routes.ai import check_openai_limit
+    fake_stream = MagicMock()
+    fake_stream.__aiter__.return_value = fake_chunks
+    fake_stream.close = AsyncMock()
 
-    result = await check_openai_limit()
-    assert result is False
+    mock_client = MagicMock()
+    mock_client.chat.completions.create = AsyncMock(return_value=fake_stream)
 
+    monkeypatch.setattr(ai, "openai_client", mock_client)
+    monkeypatch.setattr(ai, "_openai_blocked_until", 0.0)
+    chunks, error = await ai.open_openai_stream(("system", "prompt"))
+    assert error is None
+    assert [text async for text in chunks] == ["Open", "AI"]
 
-@pytest.mark.asyncio
-@patch("httpx.AsyncClient.get", side_effect=Exception("Connection error"))
-async def test_check_openai_limit_exception(mock_httpx_get):
-    """Test exception handling in OpenAI limit check"""
-    from routes.ai import check_openai_limit
+    # The upstream response is released once relaying ends
+    fake_stream.close.assert_awaited_once()
 
-    result = await check_openai_limit()
-    assert result is False
 
+def test_sse_event_escapes_newlines():
+    """Test multi-line chunks stay inside a single SSE data line"""
+    assert sse_event("a\nb") == 'data: "a\\nb"\n\n'
 
-@pytest.mark.asyncio
-async def test_rate_limit():
+
+def test_stream_suggestions_reports_cache_status():
+    """Test streamed responses say whether they were served from the cache"""
+    hit = stream_suggestions(ai._single_chunk("cached"), "OpenAI")
+    miss = stream_suggestions(ai._single_chunk("fresh"), "OpenAI", cache_key=b"key")
+    assert hit.headers["X-Cache"] == "HIT"
+    assert miss.headers["X-Cache"] == "MISS"
+
+
+@pytest.fixture
+def fresh_limiter():
+    """Clears the AI rate limits so only this test's requests are counted"""
+    ai.limiter.reset()
+    yield ai.limiter
+    ai.limiter.reset()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_rate_limit(auth_client, fresh_limiter):
     """Test if rate limiting works (returns HTTP 429 on excessive requests)"""
-    # Make multiple requests to trigger rate limit
-    for _ in range(10):  # Exceeding the rate limit intentionally
-        client.post("/ai/debug/1", headers={"Authorization": "Bearer testtoken"})
+    # More concurrent requests than the per-minute limit allows
+    responses = await asyncio.gather(
+        *(
+            auth_client.post(
+                "/ai/debug/1", headers={"Authorization": "Bearer testtoken"}
+            )
+            for _ in range(11)
+        )
+    )
 
-    response = client.post("/ai/debug/1", headers={"Authorization": "Bearer testtoken"})
-    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
-    assert "Too many requests" in response.json()["error"]
+    limited = [
+        response
+        for response in responses
+        if response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    ]
+    assert limited
+    assert "Too many requests" in limited[0].json()["error"]
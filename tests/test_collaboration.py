@@ -1,39 +1,50 @@
-import sys
-import os
-
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 import pytest
-import time
+import asyncio
 import json
-from fastapi.testclient import TestClient
 from fastapi.websockets import WebSocketDisconnect
-from main import app  # Adjust import path according to your project structure
 from routes.collaboration import (
     cleanup_connection,
     cleanup_notification_connection,
     active_connections,
     notification_connections,
-    message_history,
+    file_subscribers,
+    outboxes,
+    fan_out,
+    is_rate_limited,
+    RateLimitState,
+    BROADCAST_BATCH_SIZE,
+    MAX_MESSAGES,
+    TIME_WINDOW,
 )
 
-client = TestClient(app)
+# Each pytest-xdist worker has its own copy of the connection tables above. Within
+# a worker every test uses its own file ids and only looks at those ids' entries
+pytestmark = pytest.mark.websocket
+
+
+@pytest.fixture
+def frozen_clock(monkeypatch):
+    """Hold the rate limiter's clock still, so every message lands in one window"""
+    import routes.collaboration as collaboration
+
+    monkeypatch.setattr(collaboration, "clock", lambda: 0.0)
 
 
 @pytest.mark.asyncio
-async def test_websocket_connection():
+async def test_websocket_connection(client):
     """Test if the WebSocket connection opens successfully"""
     file_id = 1
-    with client.websocket_connect(f"/ws/{file_id}") as websocket:
+    with client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket:
         assert websocket is not None
 
 
 @pytest.mark.asyncio
-async def test_websocket_message_exchange():
+async def test_websocket_message_exchange(client):
     """Test if messages are properly sent and received"""
     file_id = 2
     with (
-        client.websocket_connect(f"/ws/{file_id}") as websocket1,
-        client.websocket_connect(f"/ws/{file_id}") as websocket2,
+        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket1,
+        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket2,
     ):
         message = "Hello, WebSocket!"
         websocket1.send_text(message)
@@ -42,42 +53,95 @@ async def test_websocket_message_exchange():
 
 
 @pytest.mark.asyncio
-async def test_websocket_rate_limiting():
+async def test_websocket_binary_relay(client):
+    """Test if binary frames are relayed to peers as binary without decoding"""
+    file_id = 27
+    with (
+        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket1,
+        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket2,
+    ):
+        message = "print('héllo')".encode("utf-8")
+        websocket1.send_bytes(message)
+        received = websocket2.receive_bytes()
+        assert received == message
+
+
+@pytest.mark.asyncio
+async def test_websocket_batched_relay(client):
+    """Test if a batching client receives bursts as JSON arrays in send order"""
+    file_id = 24
+    with (
+        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket1,
+        client.websocket_connect(f"/collaborate/ws/{file_id}?batch=true") as websocket2,
+    ):
+        messages = ["a = 1\n", "b = 2\n", "c = 3\n"]
+        for message in messages:
+            websocket1.send_text(message)
+
+        received = []
+        while len(received) < len(messages):
+            received.extend(json.loads(websocket2.receive_text()))
+        assert received == messages
+
+
+@pytest.mark.asyncio
+async def test_fan_out_reaches_every_peer_across_batches():
+    """Test if a broadcast larger than one batch is queued for every peer"""
+    peers = [object() for _ in range(BROADCAST_BATCH_SIZE * 2 + 1)]
+    for peer in peers:
+        outboxes[peer] = asyncio.Queue()
+    try:
+        await fan_out(peers, "update")
+        assert all(outboxes[peer].get_nowait() == "update" for peer in peers)
+    finally:
+        for peer in peers:
+            outboxes.pop(peer, None)
+
+
+@pytest.mark.asyncio
+async def test_websocket_rate_limiting(client, frozen_clock):
     """Test if the rate limiter blocks excessive messages"""
     file_id = 3
-    with client.websocket_connect(f"/ws/{file_id}") as websocket:
+    with client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket:
         for _ in range(10):  # Send MAX_MESSAGES
             websocket.send_text("Test Message")
-            time.sleep(0.05)  # Ensure messages are within TIME_WINDOW
 
         websocket.send_text("Excess Message")
         error_response = websocket.receive_text()
         assert "Error: Rate limit exceeded" in error_response
 
 
+def test_rate_limit_window_resets():
+    """Test if the counter rejects messages past the limit until the window expires"""
+    state = RateLimitState()
+    assert not any(is_rate_limited(state) for _ in range(MAX_MESSAGES))
+    assert is_rate_limited(state)
+
+    state.window_start -= TIME_WINDOW
+    assert not is_rate_limited(state)
+    assert state.count == 1
+
+
 @pytest.mark.asyncio
-async def test_websocket_cleanup_on_disconnect():
+async def test_websocket_cleanup_on_disconnect(client):
     """Test if the WebSocket cleans up connections properly after disconnect"""
     file_id = 4
-    with client.websocket_connect(f"/ws/{file_id}") as websocket:
-        websocket_id = id(websocket)
-        assert file_id in active_connections
-        assert websocket in active_connections[file_id]
+    with client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket:
+        assert len(active_connections.get(file_id, set())) == 1
 
     # Simulate cleanup after disconnect
     cleanup_connection(websocket, file_id)
 
     assert file_id not in active_connections
-    assert websocket_id not in message_history
 
 
 @pytest.mark.asyncio
-async def test_websocket_multiple_clients():
+async def test_websocket_multiple_clients(client):
     """Test multiple clients communicating via WebSocket"""
     file_id = 5
     with (
-        client.websocket_connect(f"/ws/{file_id}") as websocket1,
-        client.websocket_connect(f"/ws/{file_id}") as websocket2,
+        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket1,
+        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket2,
     ):
         websocket1.send_text("Client 1 says hi")
         websocket2.send_text("Client 2 replies hello")
@@ -90,36 +154,48 @@ async def test_websocket_multiple_clients():
 
 
 @pytest.mark.asyncio
-async def test_websocket_disconnection():
+async def test_websocket_disconnection(client):
     """Test if the WebSocket handles disconnection gracefully"""
     file_id = 6
-    with client.websocket_connect(f"/ws/{file_id}") as websocket:
+    with client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket:
         websocket.close()
 
     # Ensure connection is cleaned up
     assert file_id not in active_connections
 
 
-# Updated tests for the notification WebSocket functionality
+# Tests for the notification WebSocket functionality
+
+
+@pytest.mark.asyncio
+async def test_notification_file_subscribers_index(client):
+    """Test if the per-file subscriber index tracks connections and is cleaned up"""
+    file_id = 23
+    with client.websocket_connect(f"/collaborate/notifications/{file_id}"):
+        with client.websocket_connect(f"/collaborate/notifications/{file_id}"):
+            assert len(file_subscribers[file_id]) == 2
+        # Leaving the block waits for the server handler, so cleanup has run
+        assert len(file_subscribers[file_id]) == 1
+    assert not file_subscribers.get(file_id)
 
 
 @pytest.mark.asyncio
-async def test_notification_websocket_connection():
+async def test_notification_websocket_connection(client):
     """Test if the notification WebSocket connection opens successfully for a specific file"""
     file_id = 10
-    with client.websocket_connect(f"/notifications/{file_id}") as websocket:
+    with client.websocket_connect(f"/collaborate/notifications/{file_id}") as websocket:
         assert websocket is not None
-        assert websocket in notification_connections
-        assert file_id in notification_connections[websocket]
+        (server_socket,) = file_subscribers.get(file_id, set())
+        assert file_id in notification_connections[server_socket]
 
 
 @pytest.mark.asyncio
-async def test_notification_message_exchange_same_file():
+async def test_notification_message_exchange_same_file(client):
     """Test if notification messages for the same file are properly sent and received"""
     file_id = 11
     with (
-        client.websocket_connect(f"/notifications/{file_id}") as websocket1,
-        client.websocket_connect(f"/notifications/{file_id}") as websocket2,
+        client.websocket_connect(f"/collaborate/notifications/{file_id}") as websocket1,
+        client.websocket_connect(f"/collaborate/notifications/{file_id}") as websocket2,
     ):
         notification = {
             "type": "test_notification",
@@ -136,13 +212,17 @@ async def test_notification_message_exchange_same_file():
 
 
 @pytest.mark.asyncio
-async def test_notification_message_different_files():
+async def test_notification_message_different_files(client):
     """Test that notifications for one file don't go to connections for other files"""
     file_id_1 = 12
     file_id_2 = 13
     with (
-        client.websocket_connect(f"/notifications/{file_id_1}") as websocket1,
-        client.websocket_connect(f"/notifications/{file_id_2}") as websocket2,
+        client.websocket_connect(
+            f"/collaborate/notifications/{file_id_1}"
+        ) as websocket1,
+        client.websocket_connect(
+            f"/collaborate/notifications/{file_id_2}"
+        ) as websocket2,
     ):
         notification = {
             "type": "test_notification",
@@ -162,248 +242,50 @@ async def test_notification_message_different_files():
 
 
 @pytest.mark.asyncio
-async def test_subscribe_to_additional_file():
-    """Test subscribing to additional files"""
+async def test_subscribe_to_additional_file(client):
+    """Test subscribing a notification connection to additional files"""
     original_file_id = 14
     additional_file_id = 15
 
     # Connect to the notification system for one file
-    with client.websocket_connect(f"/notifications/{original_file_id}") as websocket:
-        # Subscribe to another file
-        with client.websocket_connect(
-            f"/notifications/subscribe/{additional_file_id}"
-        ) as subscribe_socket:
-            response = json.loads(subscribe_socket.receive_text())
-            assert response["type"] == "subscription"
-            assert response["file_id"] == additional_file_id
-            assert response["status"] == "subscribed"
+    with client.websocket_connect(
+        f"/collaborate/notifications/{original_file_id}"
+    ) as websocket:
+        # Subscribe to another file on the same connection
+        websocket.send_text(
+            json.dumps({"type": "subscribe", "file_id": additional_file_id})
+        )
+        response = json.loads(websocket.receive_text())
+        assert response["type"] == "subscription"
+        assert response["file_id"] == additional_file_id
+        assert response["status"] == "subscribed"
 
         # Verify in the notification_connections
-        assert websocket in notification_connections
-        assert original_file_id in notification_connections[websocket]
-        assert additional_file_id in notification_connections[websocket]
-
-
-import sys
-import os
-
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-import pytest
-import time
-import json
-from fastapi.testclient import TestClient
-from fastapi.websockets import WebSocketDisconnect
-from main import app  # Adjust import path according to your project structure
-from routes.collaboration import (
-    cleanup_connection,
-    cleanup_notification_connection,
-    active_connections,
-    notification_connections,
-    message_history,
-)
-
-client = TestClient(app)
-
-
-@pytest.mark.asyncio
-async def test_websocket_connection():
-    """Test if the WebSocket connection opens successfully"""
-    file_id = 1
-    with client.websocket_connect(f"/ws/{file_id}") as websocket:
-        assert websocket is not None
-
-
-@pytest.mark.asyncio
-async def test_websocket_message_exchange():
-    """Test if messages are properly sent and received"""
-    file_id = 2
-    with (
-        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket1,
-        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket2,
-    ):
-        message = "Hello, WebSocket!"
-        websocket1.send_text(message)
-        received = websocket2.receive_text()
-        assert received == message
-
-
-@pytest.mark.asyncio
-async def test_websocket_rate_limiting():
-    """Test if the rate limiter blocks excessive messages"""
-    file_id = 3
-    with client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket:
-        for _ in range(10):  # Send MAX_MESSAGES
-            websocket.send_text("Test Message")
-            time.sleep(0.05)  # Ensure messages are within TIME_WINDOW
-
-        websocket.send_text("Excess Message")
-        error_response = websocket.receive_text()
-        assert "Error: Rate limit exceeded" in error_response
-
-
-@pytest.mark.asyncio
-async def test_websocket_cleanup_on_disconnect():
-    """Test if the WebSocket cleans up connections properly after disconnect"""
-    file_id = 4
-    with client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket:
-        websocket_id = id(websocket)
-        assert file_id in active_connections
-        assert websocket in active_connections[file_id]
-
-    # Simulate cleanup after disconnect
-    cleanup_connection(websocket, file_id)
-
-    assert file_id not in active_connections
-    assert websocket_id not in message_history
-
-
-@pytest.mark.asyncio
-async def test_websocket_multiple_clients():
-    """Test multiple clients communicating via WebSocket"""
-    file_id = 5
-    with (
-        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket1,
-        client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket2,
-    ):
-        websocket1.send_text("Client 1 says hi")
-        websocket2.send_text("Client 2 replies hello")
-
-        received1 = websocket1.receive_text()
-        received2 = websocket2.receive_text()
-
-        assert received1 == "Client 2 replies hello"
-        assert received2 == "Client 1 says hi"
-
-
-@pytest.mark.asyncio
-async def test_websocket_disconnection():
-    """Test if the WebSocket handles disconnection gracefully"""
-    file_id = 6
-    with client.websocket_connect(f"/collaborate/ws/{file_id}") as websocket:
-        websocket.close()
-
-    # Ensure connection is cleaned up
-    assert file_id not in active_connections
-
-
-# New tests for the notification WebSocket functionality
-
-
-@pytest.mark.asyncio
-async def test_notification_websocket_connection():
-    """Test if the notification WebSocket connection opens successfully"""
-    with client.websocket_connect("/collaborate/notifications") as websocket:
-        assert websocket is not None
-        assert websocket in notification_connections
-
-
-@pytest.mark.asyncio
-async def test_notification_message_exchange():
-    """Test if notification messages are properly sent and received"""
-    with (
-        client.websocket_connect("/collaborate/notifications") as websocket1,
-        client.websocket_connect("/collaborate/notifications") as websocket2,
-    ):
-        notification = {
-            "type": "test_notification",
-            "message": "Test notification message",
-        }
-
-        websocket1.send_text(json.dumps(notification))
-        received = json.loads(websocket2.receive_text())
-
-        assert received["type"] == notification["type"]
-        assert received["message"] == notification["message"]
-
-
-@pytest.mark.asyncio
-async def test_notification_rate_limiting():
-    """Test if the rate limiter blocks excessive notification messages"""
-    with client.websocket_connect("/collaborate/notifications") as websocket:
-        notification = {
-            "type": "test_notification",
-            "message": "Test notification message",
+        (server_socket,) = file_subscribers[original_file_id]
+        assert file_subscribers[additional_file_id] == {server_socket}
+        assert notification_connections[server_socket] == {
+            original_file_id,
+            additional_file_id,
         }
 
-        for _ in range(10):  # Send MAX_MESSAGES
-            websocket.send_text(json.dumps(notification))
-            time.sleep(0.05)  # Ensure messages are within TIME_WINDOW
-
-        websocket.send_text(json.dumps(notification))
-        error_response = websocket.receive_text()
-
-        assert "Error: Rate limit exceeded" in error_response
-
-
-@pytest.mark.asyncio
-async def test_notification_cleanup_on_disconnect():
-    """Test if the notification WebSocket cleans up connections properly after disconnect"""
-    with client.websocket_connect("/collaborate/notifications") as websocket:
-        websocket_id = id(websocket)
-        assert websocket in notification_connections
-
-    # Simulate cleanup after disconnect
-    cleanup_notification_connection(websocket)
-
-    assert websocket not in notification_connections
-    assert websocket_id not in message_history
-
 
 @pytest.mark.asyncio
-async def test_notification_invalid_json():
-    """Test handling of invalid JSON in notification messages"""
-    with client.websocket_connect("/collaborate/notifications") as websocket:
-        # Send invalid JSON
-        websocket.send_text("{invalid json")
-        error_response = websocket.receive_text()
-
-        assert "Error: Invalid notification format" in error_response
-
-
-@pytest.mark.asyncio
-async def test_user_join_notification():
-    """Test if joining a file broadcasts a notification"""
-    file_id = 7
-
-    # First connect to the notification WebSocket
+async def test_subscribe_endpoint_points_to_message(client):
+    """Test the standalone subscribe socket explains how to subscribe"""
     with client.websocket_connect(
-        "/collaborate/notifications"
-    ) as notification_websocket:
-        # Then connect to a file WebSocket
-        with client.websocket_connect(f"/collaborate/ws/{file_id}") as file_websocket:
-            # We should receive a user_joined notification
-            notification = json.loads(notification_websocket.receive_text())
-
-            assert notification["type"] == "user_joined"
-            assert notification["file_id"] == file_id
+        "/collaborate/notifications/subscribe/15"
+    ) as subscribe_socket:
+        response = json.loads(subscribe_socket.receive_text())
+        assert response["type"] == "error"
+        assert '"type": "subscribe"' in response["message"]
+    assert not file_subscribers.get(15)
 
 
 @pytest.mark.asyncio
-async def test_user_leave_notification():
-    """Test if leaving a file broadcasts a notification"""
-    file_id = 8
-
-    # First connect to the notification WebSocket
-    with client.websocket_connect(
-        "/collaborate/notifications"
-    ) as notification_websocket:
-        # Create a context for the file WebSocket that we'll exit
-        with client.websocket_connect(f"/collaborate/ws/{file_id}"):
-            # Receive and ignore the join notification
-            notification_websocket.receive_text()
-
-        # After the file WebSocket context exits, we should receive a user_left notification
-        notification = json.loads(notification_websocket.receive_text())
-
-        assert notification["type"] == "user_left"
-        assert notification["file_id"] == file_id
-
-
-@pytest.mark.asyncio
-async def test_notification_rate_limiting():
+async def test_notification_rate_limiting(client, frozen_clock):
     """Test if the rate limiter blocks excessive notification messages"""
     file_id = 16
-    with client.websocket_connect(f"/notifications/{file_id}") as websocket:
+    with client.websocket_connect(f"/collaborate/notifications/{file_id}") as websocket:
         notification = {
             "type": "test_notification",
             "message": "Test notification message",
@@ -412,7 +294,6 @@ async def test_notification_rate_limiting():
 
         for _ in range(10):  # Send MAX_MESSAGES
             websocket.send_text(json.dumps(notification))
-            time.sleep(0.05)  # Ensure messages are within TIME_WINDOW
 
         websocket.send_text(json.dumps(notification))
         error_response = websocket.receive_text()
@@ -421,25 +302,23 @@ async def test_notification_rate_limiting():
 
 
 @pytest.mark.asyncio
-async def test_notification_cleanup_on_disconnect():
+async def test_notification_cleanup_on_disconnect(client):
     """Test if the notification WebSocket cleans up connections properly after disconnect"""
     file_id = 17
-    with client.websocket_connect(f"/notifications/{file_id}") as websocket:
-        websocket_id = id(websocket)
-        assert websocket in notification_connections
+    with client.websocket_connect(f"/collaborate/notifications/{file_id}") as websocket:
+        assert len(file_subscribers.get(file_id, set())) == 1
 
     # Simulate cleanup after disconnect
     cleanup_notification_connection(websocket)
 
-    assert websocket not in notification_connections
-    assert websocket_id not in message_history
+    assert not file_subscribers.get(file_id)
 
 
 @pytest.mark.asyncio
-async def test_notification_invalid_json():
+async def test_notification_invalid_json(client):
     """Test handling of invalid JSON in notification messages"""
     file_id = 18
-    with client.websocket_connect(f"/notifications/{file_id}") as websocket:
+    with client.websocket_connect(f"/collaborate/notifications/{file_id}") as websocket:
         # Send invalid JSON
         websocket.send_text("{invalid json")
         error_response = websocket.receive_text()
@@ -448,21 +327,23 @@ async def test_notification_invalid_json():
 
 
 @pytest.mark.asyncio
-async def test_user_join_notification():
+async def test_user_join_notification(client):
     """Test if joining a file broadcasts a notification only to subscribers of that file"""
     file_id_1 = 19
     file_id_2 = 20
 
     # First connect to the notification WebSocket for file_id_1
     with client.websocket_connect(
-        f"/notifications/{file_id_1}"
+        f"/collaborate/notifications/{file_id_1}"
     ) as notification_websocket1:
         # Connect to notification WebSocket for file_id_2
         with client.websocket_connect(
-            f"/notifications/{file_id_2}"
+            f"/collaborate/notifications/{file_id_2}"
         ) as notification_websocket2:
             # Then connect to file_id_1's file WebSocket
-            with client.websocket_connect(f"/ws/{file_id_1}") as file_websocket:
+            with client.websocket_connect(
+                f"/collaborate/ws/{file_id_1}"
+            ) as file_websocket:
                 # notification_websocket1 should receive a user_joined notification
                 notification = json.loads(notification_websocket1.receive_text())
                 assert notification["type"] == "user_joined"
@@ -475,7 +356,7 @@ async def test_user_join_notification():
 
 
 @pytest.mark.asyncio
-async def test_user_leave_notification():
+async def test_user_leave_notification(client):
     """Test if leaving a file broadcasts a notification only to subscribers of that file"""
     file_id_1 = 21
     file_id_2 = 22
@@ -483,14 +364,14 @@ async def test_user_leave_notification():
     # Connect to the notification WebSocket for both files
     with (
         client.websocket_connect(
-            f"/notifications/{file_id_1}"
+            f"/collaborate/notifications/{file_id_1}"
         ) as notification_websocket1,
         client.websocket_connect(
-            f"/notifications/{file_id_2}"
+            f"/collaborate/notifications/{file_id_2}"
         ) as notification_websocket2,
     ):
         # Create a context for the file WebSocket that we'll exit
-        with client.websocket_connect(f"/ws/{file_id_1}"):
+        with client.websocket_connect(f"/collaborate/ws/{file_id_1}"):
             # Receive and ignore the join notification on websocket1
             notification_websocket1.receive_text()
 
@@ -505,28 +386,33 @@ async def test_user_leave_notification():
 
 
 @pytest.mark.asyncio
-async def test_multiple_file_subscriptions():
+async def test_multiple_file_subscriptions(client):
     """Test that a single connection can receive notifications for multiple files"""
-    file_id_1 = 23
-    file_id_2 = 24
+    file_id_1 = 25
+    file_id_2 = 26
 
     # Connect to the notification system for file_id_1
-    with client.websocket_connect(f"/notifications/{file_id_1}") as websocket:
+    with client.websocket_connect(
+        f"/collaborate/notifications/{file_id_1}"
+    ) as websocket:
         # Subscribe to file_id_2
-        with client.websocket_connect(
-            f"/notifications/subscribe/{file_id_2}"
-        ) as subscribe_socket:
-            response = json.loads(subscribe_socket.receive_text())
-            assert response["status"] == "subscribed"
+        websocket.send_text(json.dumps({"type": "subscribe", "file_id": file_id_2}))
+        response = json.loads(websocket.receive_text())
+        assert response["status"] == "subscribed"
 
         # Now connect to file_id_1 - should trigger a notification
-        with client.websocket_connect(f"/ws/{file_id_1}"):
+        with client.websocket_connect(f"/collaborate/ws/{file_id_1}"):
             notification1 = json.loads(websocket.receive_text())
             assert notification1["type"] == "user_joined"
             assert notification1["file_id"] == file_id_1
 
+        # Leaving file_id_1 is announced before anything else arrives
+        notification1 = json.loads(websocket.receive_text())
+        assert notification1["type"] == "user_left"
+        assert notification1["file_id"] == file_id_1
+
         # Now connect to file_id_2 - should also trigger a notification
-        with client.websocket_connect(f"/ws/{file_id_2}"):
+        with client.websocket_connect(f"/collaborate/ws/{file_id_2}"):
             notification2 = json.loads(websocket.receive_text())
             assert notification2["type"] == "user_joined"
             assert notification2["file_id"] == file_id_2
@@ -1,273 +1,287 @@
+import httpx
 import pytest
-from fastapi.testclient import TestClient
-from datetime import timedelta
 from sqlalchemy.orm import Session
-import sys
-import os
 
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models import CodeFile, User
+from routes.files import PAGE_MAX_FILES, STREAM_CHUNK_SIZE
+from tests.conftest import TestingSessionLocal, clear_tables
+from tests.helpers import auth_headers, hash_password
 
-from main import app
-from models import CodeFile
-from auth import create_access_token
-from tests.conftest import override_get_db, TestingSessionLocal
-from tests.test_users import create_test_user
-from auth import get_db
 
-app.dependency_overrides[get_db] = override_get_db
-client = TestClient(app)
+@pytest.fixture(scope="module")
+def headers():
+    """Looks up the cached bearer header for a user"""
+    return lambda user: auth_headers(user.username)
 
 
-#  Helper function to generate auth token
-def get_auth_token(username):
-    return create_access_token(
-        data={"sub": username}, expires_delta=timedelta(minutes=30)
+@pytest.fixture(scope="module")
+def users(test_database):
+    """Creates the file owner and a second user once for the whole module"""
+    # Both users go in with one commit
+    db: Session = TestingSessionLocal()
+    owner, other = (
+        User(username=username, hashed_password=hash_password("testpass"))
+        for username in ("fileuser", "otherfileuser")
     )
+    db.add_all([owner, other])
+    db.commit()
+    db.close()
+    yield owner, other
 
+    clear_tables()
+
+
+@pytest.fixture
+def db(users):
+    """Session for seeding files, the module's users are kept between tests"""
+    session = TestingSessionLocal()
+    yield session
+    session.close()
+
+    clear_tables(CodeFile.__table__)
+
+
+def add_file(db: Session, user, title, content):
+    file = CodeFile(user_id=user.id, title=title, content=content)
+    db.add(file)
+    db.commit()
+    return file.id
 
-def test_create_file():
-    db: Session = TestingSessionLocal()
-    user = create_test_user(db, "fileuser", "testpass")
-    db.close()
 
-    token = get_auth_token(user.username)
-    headers = {"Authorization": f"Bearer {token}"}
+@pytest.mark.asyncio(loop_scope="session")
+async def test_create_file(
+    async_client: httpx.AsyncClient, db: Session, users, headers
+):
+    owner, _ = users
 
     # Case 1: Successfully create a file
     payload = {"title": "My Unique File"}
-    response = client.post("/files/", headers=headers, json=payload)
+    response = await async_client.post("/files/", headers=headers(owner), json=payload)
 
     assert response.status_code == 201
-    assert "newFile" in response.json()
-    assert response.json()["newFile"]["title"] == "My Unique File"
-    assert response.json()["message"] == "Code File successfully created"
+    body = response.json()
+    assert "newFile" in body
+    assert body["newFile"]["title"] == "My Unique File"
+    assert body["message"] == "Code File successfully created"
 
     # Case 2: Title cannot be empty
     payload = {"title": " "}
-    response = client.post("/files/", headers=headers, json=payload)
+    response = await async_client.post("/files/", headers=headers(owner), json=payload)
 
     assert response.status_code == 400
     assert response.json()["detail"] == "Title cannot be empty."
 
     # Case 3: Title must be unique for the user
-    response = client.post("/files/", headers=headers, json={"title": "My Unique File"})
+    response = await async_client.post(
+        "/files/", headers=headers(owner), json={"title": "My Unique File"}
+    )
 
     assert response.status_code == 400
     assert response.json()["detail"] == "Title must be unique for the user."
 
 
 #   Retrieve a file successfully
-def test_get_file():
-    db: Session = TestingSessionLocal()
-    user = create_test_user(db, "filefetchuser", "testpass")
-
-    new_file = CodeFile(user_id=user.id, content="Sample Content")
-    db.add(new_file)
-    db.commit()
-    db.refresh(new_file)
-    db.close()
-
-    token = get_auth_token(user.username)
-    headers = {"Authorization": f"Bearer {token}"}
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_file(async_client: httpx.AsyncClient, db: Session, users, headers):
+    owner, _ = users
+    file_id = add_file(db, owner, "Sample", "Sample Content")
 
-    response = client.get(f"/files/{new_file.id}", headers=headers)
+    response = await async_client.get(f"/files/{file_id}", headers=headers(owner))
 
     assert response.status_code == 200
-    assert response.json()["file"]["id"] == new_file.id
-    assert response.json()["file"]["content"] == "Sample Content"
-
-
-#   Get all files for a user
-def test_get_all_files():
-    db: Session = TestingSessionLocal()
-    user = create_test_user(db, "filelistuser", "testpass")
+    body = response.json()
+    assert body["file"]["id"] == file_id
+    assert body["file"]["content"] == "Sample Content"
 
-    file1 = CodeFile(user_id=user.id, content="File 1")
-    file2 = CodeFile(user_id=user.id, content="File 2")
-    db.add_all([file1, file2])
-    db.commit()
-    db.close()
 
-    token = get_auth_token(user.username)
-    headers = {"Authorization": f"Bearer {token}"}
+#   Files larger than one chunk are streamed, the body is the same JSON
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_large_file(
+    async_client: httpx.AsyncClient, db: Session, users, headers
+):
+    owner, _ = users
+    content = 'print("héllo")\n' * (STREAM_CHUNK_SIZE // 5)
+    assert len(content) > 2 * STREAM_CHUNK_SIZE
+    file_id = add_file(db, owner, "Large", content)
 
-    response = client.get("/files/", headers=headers)
+    response = await async_client.get(f"/files/{file_id}", headers=headers(owner))
 
     assert response.status_code == 200
-    assert len(response.json()["files"]) == 2
-
-
-#   Unauthorized user cannot access another user's file
-def test_get_file_unauthorized():
-    db: Session = TestingSessionLocal()
-    user1 = create_test_user(db, "user1", "testpass")
-    user2 = create_test_user(db, "user2", "testpass")
-
-    file = CodeFile(user_id=user2.id, content="Private File")
-    db.add(file)
-    db.commit()
-    db.refresh(file)
-    db.close()
-
-    token = get_auth_token(user1.username)
-    headers = {"Authorization": f"Bearer {token}"}
+    body = response.json()
+    assert body["file"] == {"id": file_id, "content": content, "user_id": owner.id}
+    assert body["message"] == "Code File fetched successfully"
 
-    response = client.get(f"/files/{file.id}", headers=headers)
 
-    assert response.status_code == 403
-    assert response.json()["detail"] == "Not authorized to access this file"
+#   Get all files for a user
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_all_files(
+    async_client: httpx.AsyncClient, db: Session, users, headers
+):
+    owner, _ = users
+    add_file(db, owner, "File 1", "File 1")
+    add_file(db, owner, "File 2", "File 2")
 
+    response = await async_client.get("/files/", headers=headers(owner))
 
-#   Update a file successfully
-def test_update_file():
-    db: Session = TestingSessionLocal()
-    user = create_test_user(db, "updateuser", "testpass")
+    assert response.status_code == 200
+    assert len(response.json()["files"]) == 2
 
-    # Create an initial file
-    file = CodeFile(user_id=user.id, title="Initial Title", content="Old Content")
-    db.add(file)
-    db.commit()
-    db.refresh(file)
-    db.close()
 
-    token = get_auth_token(user.username)
-    headers = {"Authorization": f"Bearer {token}"}
+#   A page can't be larger than PAGE_MAX_FILES
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_all_files_limit_capped(
+    async_client: httpx.AsyncClient, db: Session, users, headers
+):
+    owner, _ = users
 
-    # Case 1: Successfully update both title and content
-    response = client.put(
-        f"/files/{file.id}",
-        json={"title": "Updated Title", "content": "New Updated Content"},
-        headers=headers,
+    response = await async_client.get(
+        "/files/", params={"limit": PAGE_MAX_FILES + 1}, headers=headers(owner)
     )
 
-    assert response.status_code == 200
-    assert response.json()["message"] == "Code File successfully updated"
-    assert response.json()["file"]["title"] == "Updated Title"
-    assert response.json()["file"]["content"] == "New Updated Content"
-
-    # Case 2: Successfully update only content
-    response = client.put(
-        f"/files/{file.id}",
-        json={"content": "Another Update"},
-        headers=headers,
+    assert response.status_code == 422
+
+
+#   Unauthorized user cannot read, update or delete another user's file
+# GET answers 403, while update and delete have always answered 401
+@pytest.mark.parametrize(
+    "method,kwargs,expected_status,detail",
+    [
+        ("GET", {}, 403, "Not authorized to access this file"),
+        (
+            "PUT",
+            {"json": {"content": "Hacked Content"}},
+            401,
+            "Not authorized to update this file",
+        ),
+        ("DELETE", {}, 401, "Not authorized to delete this file"),
+    ],
+    ids=["get", "update", "delete"],
+)
+@pytest.mark.asyncio(loop_scope="session")
+async def test_file_unauthorized(
+    async_client: httpx.AsyncClient,
+    db: Session,
+    users,
+    headers,
+    method,
+    kwargs,
+    expected_status,
+    detail,
+):
+    owner, other = users
+    file_id = add_file(db, other, "Secret", "Secret File")
+
+    response = await async_client.request(
+        method, f"/files/{file_id}", headers=headers(owner), **kwargs
     )
 
-    assert response.status_code == 200
-    assert response.json()["file"]["content"] == "Another Update"
+    assert response.status_code == expected_status
+    assert response.json()["detail"] == detail
 
-    # Case 3: Successfully update only title
-    response = client.put(
-        f"/files/{file.id}",
-        json={"title": "New Unique Title"},
-        headers=headers,
-    )
 
-    assert response.status_code == 200
-    assert response.json()["file"]["title"] == "New Unique Title"
+@pytest.fixture
+def file_id(db: Session, users):
+    """The owner's file the update tests edit, next to a second file whose title is taken"""
+    owner, _ = users
+    add_file(db, owner, "Duplicate Title", "Some Content")
+    return add_file(db, owner, "Initial Title", "Old Content")
 
-    # Case 4: Title must be unique (creating another file for the same user)
-    another_file = CodeFile(
-        user_id=user.id, title="Duplicate Title", content="Some Content"
+
+#   Update a file successfully
+@pytest.mark.parametrize(
+    "payload",
+    [
+        pytest.param(
+            {"title": "Updated Title", "content": "New Updated Content"},
+            id="title-and-content",
+        ),
+        pytest.param({"content": "Another Update"}, id="content-only"),
+        pytest.param({"title": "New Unique Title"}, id="title-only"),
+    ],
+)
+@pytest.mark.asyncio(loop_scope="session")
+async def test_update_file(
+    async_client: httpx.AsyncClient, file_id, users, headers, payload
+):
+    owner, _ = users
+
+    response = await async_client.put(
+        f"/files/{file_id}", json=payload, headers=headers(owner)
     )
-    db.add(another_file)
-    db.commit()
-    db.refresh(another_file)
 
-    response = client.put(
-        f"/files/{file.id}",
-        json={"title": "Duplicate Title"},
-        headers=headers,
+    assert response.status_code == 200
+    body = response.json()
+    assert body["message"] == "Code File successfully updated"
+    for field, value in payload.items():
+        assert body["file"][field] == value
+
+
+#   Rejected updates
+@pytest.mark.parametrize(
+    "payload,detail",
+    [
+        # Title must be unique for the user
+        ({"title": "Duplicate Title"}, "Title must be unique for the user."),
+        # At least one field (title or content) must be provided
+        ({}, "At least one of 'title' or 'content' must be provided."),
+    ],
+    ids=["duplicate-title", "empty"],
+)
+@pytest.mark.asyncio(loop_scope="session")
+async def test_update_file_invalid(
+    async_client: httpx.AsyncClient, file_id, users, headers, payload, detail
+):
+    owner, _ = users
+
+    response = await async_client.put(
+        f"/files/{file_id}", json=payload, headers=headers(owner)
     )
 
     assert response.status_code == 400
-    assert response.json()["detail"] == "Title must be unique for the user."
+    assert response.json()["detail"] == detail
 
-    # Case 5: At least one field (title or content) must be provided
-    response = client.put(f"/files/{file.id}", json={}, headers=headers)
 
-    assert response.status_code == 400
-    assert response.json()["detail"] == "Either title or content must be provided."
+#   Update a file that doesn't exist
+@pytest.mark.asyncio(loop_scope="session")
+async def test_update_file_not_found(
+    async_client: httpx.AsyncClient, db: Session, users, headers
+):
+    owner, _ = users
 
-    # Case 6: File not found
-    response = client.put(f"/files/9999", json={"title": "Not Found"}, headers=headers)
+    response = await async_client.put(
+        "/files/9999", json={"title": "Not Found"}, headers=headers(owner)
+    )
 
     assert response.status_code == 404
     assert response.json()["detail"] == "Code File not found"
 
-    # Case 7: Unauthorized user attempting to update the file
-    another_user = create_test_user(db, "unauthorizeduser", "testpass")
-    another_token = get_auth_token(another_user.username)
-    another_headers = {"Authorization": f"Bearer {another_token}"}
 
-    response = client.put(
-        f"/files/{file.id}",
+#   Another user attempting to update the file
+@pytest.mark.asyncio(loop_scope="session")
+async def test_update_file_other_user(
+    async_client: httpx.AsyncClient, file_id, users, headers
+):
+    _, other = users
+
+    response = await async_client.put(
+        f"/files/{file_id}",
         json={"content": "Unauthorized Update"},
-        headers=another_headers,
+        headers=headers(other),
     )
 
     assert response.status_code == 401
-    assert response.json()["detail"] == "Not authorized to update this file."
-
-
-#   Prevent unauthorized file update
-def test_update_file_unauthorized():
-    db: Session = TestingSessionLocal()
-    user1 = create_test_user(db, "userA", "testpass")
-    user2 = create_test_user(db, "userB", "testpass")
-
-    file = CodeFile(user_id=user2.id, content="Secret Content")
-    db.add(file)
-    db.commit()
-    db.refresh(file)
-    db.close()
-
-    token = get_auth_token(user1.username)
-    headers = {"Authorization": f"Bearer {token}"}
-
-    response = client.put(
-        f"/files/{file.id}", json={"content": "Hacked Content"}, headers=headers
-    )
-
-    assert response.status_code == 403
     assert response.json()["detail"] == "Not authorized to update this file"
 
 
 #  Delete a file successfully
-def test_delete_file():
-    db: Session = TestingSessionLocal()
-    user = create_test_user(db, "deleteuser", "testpass")
-
-    file = CodeFile(user_id=user.id, content="To be deleted")
-    db.add(file)
-    db.commit()
-    db.refresh(file)
-    db.close()
-
-    token = get_auth_token(user.username)
-    headers = {"Authorization": f"Bearer {token}"}
+@pytest.mark.asyncio(loop_scope="session")
+async def test_delete_file(
+    async_client: httpx.AsyncClient, db: Session, users, headers
+):
+    owner, _ = users
+    file_id = add_file(db, owner, "Doomed", "To be deleted")
 
-    response = client.delete(f"/files/{file.id}", headers=headers)
+    response = await async_client.delete(f"/files/{file_id}", headers=headers(owner))
 
     assert response.status_code == 200
-    assert response.json()["message"] == "File successfully deleted"
-
-
-#   Prevent unauthorized file deletion
-def test_delete_file_unauthorized():
-    db: Session = TestingSessionLocal()
-    user1 = create_test_user(db, "deluser1", "testpass")
-    user2 = create_test_user(db, "deluser2", "testpass")
-
-    file = CodeFile(user_id=user2.id, content="Secret File")
-    db.add(file)
-    db.commit()
-    db.refresh(file)
-    db.close()
-
-    token = get_auth_token(user1.username)
-    headers = {"Authorization": f"Bearer {token}"}
-
-    response = client.delete(f"/files/{file.id}", headers=headers)
-
-    assert response.status_code == 403
-    assert response.json()["detail"] == "Not authorized to delete this file"
+    assert response.json()["message"] == "Code File successfully deleted"
@@ -1,40 +1,15 @@
-import sys
-import os
-from datetime import timedelta
-
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import Session
-from models import User
-from auth import get_password_hash, create_access_token
-
-
-# Utility to create a test user
-def create_test_user(db: Session, username, password, is_admin=False):
-    user = User(
-        username=username,
-        hashed_password=get_password_hash(password),
-        is_admin=is_admin,
-    )
-    db.add(user)
-    db.commit()
-    db.refresh(user)
-    return user
-
-
-# Utility to get auth token
-def get_auth_token(username):
-    return create_access_token(
-        data={"sub": username}, expires_delta=timedelta(minutes=30)
-    )
+from models import CodeFile, User
+from jose import jwt
+from auth import ALGORITHM, SECRET_KEY
+from tests.helpers import create_test_user
 
 
 # Test: Create initial admin
 def test_create_initial_admin(client: TestClient, db_session: Session):
-    # Ensure no users exist in the database
-    db_session.query(User).delete()
-    db_session.commit()
-
+    # db_session starts every test on empty tables
     response = client.post(
         "/auth/initial-admin", json={"username": "admin", "password": "adminpass"}
     )
@@ -46,12 +21,12 @@ def test_create_initial_admin(client: TestClient, db_session: Session):
 def test_create_initial_admin_fails_if_users_exist(
     client: TestClient, db_session: Session
 ):
-    # Ensure at least one user exists
-    if db_session.query(User).count() == 0:
-        create_test_user(db_session, "existing_user", "password123")
+    # db_session starts every test on empty tables
+    create_test_user(db_session, "existing_user", "password123")
 
     response = client.post(
-        "/auth/initial-admin", json={"username": "another_admin", "password": "pass123"}
+        "/auth/initial-admin",
+        json={"username": "another_admin", "password": "adminpass123"},
     )
     assert response.status_code == 403
     assert (
@@ -66,20 +41,17 @@ def test_register_user(client: TestClient, db_session: Session):
         "/auth/register", json={"username": "testuser", "password": "testpass123"}
     )
     assert response.status_code == 201
-    assert response.json()["message"] == "User created successfully"
-    assert "user_id" in response.json()
-    assert response.json()["username"] == "testuser"
+    body = response.json()
+    assert body["message"] == "User created successfully"
+    assert "user_id" in body
+    assert body["username"] == "testuser"
 
 
 # Test: Register with existing username fails
 def test_register_duplicate_username(client: TestClient, db_session: Session):
     # Create a user first
     existing_username = "duplicateuser"
-    if (
-        db_session.query(User).filter(User.username == existing_username).first()
-        is None
-    ):
-        create_test_user(db_session, existing_username, "password123")
+    create_test_user(db_session, existing_username, "password123")
 
     response = client.post(
         "/auth/register", json={"username": existing_username, "password": "newpass123"}
@@ -93,26 +65,104 @@ def test_login_success(client: TestClient, db_session: Session):
     # Create a test user
     username = "loginuser"
     password = "loginpass123"
-    if db_session.query(User).filter(User.username == username).first() is None:
-        create_test_user(db_session, username, password)
+    create_test_user(db_session, username, password)
 
     response = client.post(
         "/auth/login", data={"username": username, "password": password}
     )
     assert response.status_code == 200
-    assert "access_token" in response.json()
-    assert response.json()["token_type"] == "bearer"
-    assert response.json()["message"] == "User logged in successfully"
-    assert "user" in response.json()
-    assert response.json()["user"]["username"] == username
+    body = response.json()
+    assert "access_token" in body
+    assert body["token_type"] == "bearer"
+    assert body["message"] == "User logged in successfully"
+    assert "user" in body
+    assert body["user"]["username"] == username
+
+
+# Test: Login token carries the user's id and role and authenticates requests
+def test_login_token_claims(client: TestClient, db_session: Session):
+    username = "claimsuser"
+    password = "claimspass123"
+    user = create_test_user(db_session, username, password)
+
+    response = client.post(
+        "/auth/login", data={"username": username, "password": password}
+    )
+    token = response.json()["access_token"]
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    assert payload["uid"] == user.id
+    assert payload["adm"] is False
+
+    response = client.put(
+        f"/auth/users/{user.id}",
+        json={"username": "claimsuser2"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert response.status_code == 200
+
+
+# Test: A login token stops granting admin rights or access once the user changes
+def test_login_token_follows_database(client: TestClient, db_session: Session):
+    username = "revokeduser"
+    password = "revokedpass123"
+    user = create_test_user(db_session, username, password, is_admin=True)
+
+    response = client.post(
+        "/auth/login", data={"username": username, "password": password}
+    )
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    # Demoted after login, the token's role claim no longer counts
+    user.is_admin = False
+    db_session.commit()
+    response = client.post(
+        "/auth/signup-admin",
+        json={"username": "newadmin", "password": "newadminpass123", "is_admin": True},
+        headers=headers,
+    )
+    assert response.status_code == 403
+
+    # Deleted after login, the token no longer authenticates
+    db_session.delete(user)
+    db_session.commit()
+    response = client.post("/files/", json={"title": "orphan"}, headers=headers)
+    assert response.status_code == 401
+
+
+# Test: A deleted user's token can't read files of an account that reuses its id
+def test_deleted_user_token_rejected_after_id_reuse(
+    client: TestClient, db_session: Session
+):
+    password = "reusedpass123"
+    user_id = create_test_user(db_session, "goneuser", password).id
+    response = client.post(
+        "/auth/login", data={"username": "goneuser", "password": password}
+    )
+    old_headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    response = client.delete(f"/auth/users/{user_id}", headers=old_headers)
+    assert response.status_code == 200
+
+    # SQLite hands the freed id to the next account
+    response = client.post(
+        "/auth/register", json={"username": "nextuser", "password": password}
+    )
+    assert response.status_code == 201
+    next_user = db_session.get(User, response.json()["user_id"])
+    private = CodeFile(user_id=next_user.id, title="private", content="PRIVATE")
+    db_session.add(private)
+    db_session.commit()
+
+    for path in ("/files/", f"/files/{private.id}"):
+        response = client.get(path, headers=old_headers)
+        assert response.status_code == 401
 
 
 # Test: Login with incorrect credentials fails
 def test_login_invalid_credentials(client: TestClient, db_session: Session):
     # Create a test user
     username = "invalidloginuser"
-    if db_session.query(User).filter(User.username == username).first() is None:
-        create_test_user(db_session, username, "correctpass123")
+    create_test_user(db_session, username, "correctpass123")
 
     response = client.post(
         "/auth/login", data={"username": username, "password": "wrongpass"}
@@ -122,31 +172,28 @@ def test_login_invalid_credentials(client: TestClient, db_session: Session):
 
 
 # Test: Update user (allowed for self)
-def test_update_self(client: TestClient, db_session: Session):
+def test_update_self(client: TestClient, user_ctx):
     # Create a test user
     username = "updateself"
     password = "selfpass123"
-    user = create_test_user(db_session, username, password)
-    token = get_auth_token(username)
-    headers = {"Authorization": f"Bearer {token}"}
+    user, headers = user_ctx(username, password)
 
     new_username = "updatedselfuser"
     response = client.put(
         f"/auth/users/{user.id}", json={"username": new_username}, headers=headers
     )
     assert response.status_code == 200
-    assert response.json()["message"] == "User updated successfully"
-    assert response.json()["user"]["username"] == new_username
+    body = response.json()
+    assert body["message"] == "User updated successfully"
+    assert body["user"]["username"] == new_username
 
 
 # Test: Update user password
-def test_update_password(client: TestClient, db_session: Session):
+def test_update_password(client: TestClient, user_ctx):
     # Create a test user
     username = "passwordupdateuser"
     password = "oldpass123"
-    user = create_test_user(db_session, username, password)
-    token = get_auth_token(username)
-    headers = {"Authorization": f"Bearer {token}"}
+    user, headers = user_ctx(username, password)
 
     new_password = "newpass123"
     response = client.put(
@@ -164,12 +211,10 @@ def test_update_password(client: TestClient, db_session: Session):
 
 
 # Test: Update another user fails (without admin rights)
-def test_update_user_unauthorized(client: TestClient, db_session: Session):
+def test_update_user_unauthorized(client: TestClient, db_session: Session, user_ctx):
     # Create a normal user
     normal_username = "normaluser"
-    normal_user = create_test_user(db_session, normal_username, "userpass123")
-    token = get_auth_token(normal_username)
-    headers = {"Authorization": f"Bearer {token}"}
+    normal_user, headers = user_ctx(normal_username, "userpass123")
 
     # Create another user
     other_username = "otheruser"
@@ -183,14 +228,10 @@ def test_update_user_unauthorized(client: TestClient, db_session: Session):
 
 
 # Test: Admin can update any user
-def test_admin_can_update_user(client: TestClient, db_session: Session):
+def test_admin_can_update_user(client: TestClient, db_session: Session, user_ctx):
     # Create an admin user
     admin_username = "adminforupdate"
-    admin_user = create_test_user(
-        db_session, admin_username, "adminpass123", is_admin=True
-    )
-    token = get_auth_token(admin_username)
-    headers = {"Authorization": f"Bearer {token}"}
+    admin_user, headers = user_ctx(admin_username, "adminpass123", is_admin=True)
 
     # Create a normal user
     normal_username = "normalforupdate"
@@ -204,18 +245,17 @@ def test_admin_can_update_user(client: TestClient, db_session: Session):
         headers=headers,
     )
     assert response.status_code == 200
-    assert response.json()["message"] == "User updated successfully"
-    assert response.json()["user"]["username"] == new_username
-    assert response.json()["user"]["is_admin"] is True
+    body = response.json()
+    assert body["message"] == "User updated successfully"
+    assert body["user"]["username"] == new_username
+    assert body["user"]["is_admin"] is True
 
 
 # Test: Non-admin can't change admin status
-def test_non_admin_cant_change_admin_status(client: TestClient, db_session: Session):
+def test_non_admin_cant_change_admin_status(client: TestClient, user_ctx):
     # Create a normal user
     normal_username = "cantchangeadmin"
-    normal_user = create_test_user(db_session, normal_username, "userpass123")
-    token = get_auth_token(normal_username)
-    headers = {"Authorization": f"Bearer {token}"}
+    normal_user, headers = user_ctx(normal_username, "userpass123")
 
     response = client.put(
         f"/auth/users/{normal_user.id}", json={"is_admin": True}, headers=headers
@@ -225,17 +265,16 @@ def test_non_admin_cant_change_admin_status(client: TestClient, db_session: Sess
 
 
 # Test: Delete user (self-delete allowed)
-def test_delete_self(client: TestClient, db_session: Session):
+def test_delete_self(client: TestClient, db_session: Session, user_ctx):
     # Create a test user
     username = "deleteself"
-    user = create_test_user(db_session, username, "deletepass123")
-    token = get_auth_token(username)
-    headers = {"Authorization": f"Bearer {token}"}
+    user, headers = user_ctx(username, "deletepass123")
 
     response = client.delete(f"/auth/users/{user.id}", headers=headers)
     assert response.status_code == 200
-    assert response.json()["message"] == "User deleted successfully"
-    assert response.json()["user_id"] == user.id
+    body = response.json()
+    assert body["message"] == "User deleted successfully"
+    assert body["user_id"] == user.id
 
     # Verify user no longer exists
     deleted_user = db_session.query(User).filter(User.id == user.id).first()
@@ -243,12 +282,10 @@ def test_delete_self(client: TestClient, db_session: Session):
 
 
 # Test: Deleting another user fails (without admin rights)
-def test_delete_user_unauthorized(client: TestClient, db_session: Session):
+def test_delete_user_unauthorized(client: TestClient, db_session: Session, user_ctx):
     # Create two normal users
     user_a_username = "usera"
-    user_a = create_test_user(db_session, user_a_username, "passa123")
-    token = get_auth_token(user_a_username)
-    headers = {"Authorization": f"Bearer {token}"}
+    user_a, headers = user_ctx(user_a_username, "passa123")
 
     user_b_username = "userb"
     user_b = create_test_user(db_session, user_b_username, "passb123")
@@ -263,14 +300,10 @@ def test_delete_user_unauthorized(client: TestClient, db_session: Session):
 
 
 # Test: Admin can delete any user
-def test_admin_can_delete_user(client: TestClient, db_session: Session):
+def test_admin_can_delete_user(client: TestClient, db_session: Session, user_ctx):
     # Create an admin user
     admin_username = "adminfordelete"
-    admin_user = create_test_user(
-        db_session, admin_username, "adminpass123", is_admin=True
-    )
-    token = get_auth_token(admin_username)
-    headers = {"Authorization": f"Bearer {token}"}
+    admin_user, headers = user_ctx(admin_username, "adminpass123", is_admin=True)
 
     # Create a normal user
     normal_username = "normalfordelete"
@@ -278,8 +311,9 @@ def test_admin_can_delete_user(client: TestClient, db_session: Session):
 
     response = client.delete(f"/auth/users/{normal_user.id}", headers=headers)
     assert response.status_code == 200
-    assert response.json()["message"] == "User deleted successfully"
-    assert response.json()["user_id"] == normal_user.id
+    body = response.json()
+    assert body["message"] == "User deleted successfully"
+    assert body["user_id"] == normal_user.id
 
     # Verify user was deleted
     deleted_user = db_session.query(User).filter(User.id == normal_user.id).first()
@@ -287,17 +321,10 @@ def test_admin_can_delete_user(client: TestClient, db_session: Session):
 
 
 # Test: Cannot delete last admin
-def test_cannot_delete_last_admin(client: TestClient, db_session: Session):
-    # Ensure there's only one admin
-    db_session.query(User).filter(User.is_admin == True).delete()
-    db_session.commit()
-
+def test_cannot_delete_last_admin(client: TestClient, db_session: Session, user_ctx):
+    # The tables start empty, so this is the only admin
     last_admin_username = "lastadmin"
-    last_admin = create_test_user(
-        db_session, last_admin_username, "adminpass123", is_admin=True
-    )
-    token = get_auth_token(last_admin_username)
-    headers = {"Authorization": f"Bearer {token}"}
+    last_admin, headers = user_ctx(last_admin_username, "adminpass123", is_admin=True)
 
     response = client.delete(f"/auth/users/{last_admin.id}", headers=headers)
     assert response.status_code == 400
@@ -309,14 +336,10 @@ def test_cannot_delete_last_admin(client: TestClient, db_session: Session):
 
 
 # Test: Admin can create new admin user
-def test_admin_create_admin_user(client: TestClient, db_session: Session):
+def test_admin_create_admin_user(client: TestClient, user_ctx):
     # Create an admin user
     admin_username = "adminmaker"
-    admin_user = create_test_user(
-        db_session, admin_username, "adminpass123", is_admin=True
-    )
-    token = get_auth_token(admin_username)
-    headers = {"Authorization": f"Bearer {token}"}
+    admin_user, headers = user_ctx(admin_username, "adminpass123", is_admin=True)
 
     new_admin_data = {
         "username": "newadmin",
@@ -326,18 +349,17 @@ def test_admin_create_admin_user(client: TestClient, db_session: Session):
 
     response = client.post("/auth/signup-admin", json=new_admin_data, headers=headers)
     assert response.status_code == 201
-    assert response.json()["message"] == "User created successfully"
-    assert response.json()["username"] == new_admin_data["username"]
-    assert response.json()["is_admin"] is True
+    body = response.json()
+    assert body["message"] == "User created successfully"
+    assert body["username"] == new_admin_data["username"]
+    assert body["is_admin"] is True
 
 
 # Test: Non-admin can't create admin user
-def test_non_admin_cant_create_admin(client: TestClient, db_session: Session):
+def test_non_admin_cant_create_admin(client: TestClient, user_ctx):
     # Create a normal user
     normal_username = "normauser"
-    normal_user = create_test_user(db_session, normal_username, "userpass123")
-    token = get_auth_token(normal_username)
-    headers = {"Authorization": f"Bearer {token}"}
+    normal_user, headers = user_ctx(normal_username, "userpass123")
 
     new_admin_data = {
         "username": "attemptedadmin",
@@ -354,14 +376,12 @@ def test_non_admin_cant_create_admin(client: TestClient, db_session: Session):
 
 
 # Test: Username already exists in signup-admin
-def test_signup_admin_duplicate_username(client: TestClient, db_session: Session):
+def test_signup_admin_duplicate_username(
+    client: TestClient, db_session: Session, user_ctx
+):
     # Create an admin user
     admin_username = "adminfortesting"
-    admin_user = create_test_user(
-        db_session, admin_username, "adminpass123", is_admin=True
-    )
-    token = get_auth_token(admin_username)
-    headers = {"Authorization": f"Bearer {token}"}
+    admin_user, headers = user_ctx(admin_username, "adminpass123", is_admin=True)
 
     # Create another user
     existing_username = "existingusername"
@@ -379,48 +399,35 @@ def test_signup_admin_duplicate_username(client: TestClient, db_session: Session
     assert response.json()["detail"] == "Username already registered"
 
 
-# Test: User not found when updating
-def test_update_user_not_found(client: TestClient, db_session: Session):
+# Test: User not found when updating or deleting
+@pytest.mark.parametrize(
+    "method,body",
+    [("PUT", {"username": "newname"}), ("DELETE", None)],
+)
+def test_user_not_found(client: TestClient, method, body, user_ctx):
     # Create a user
-    username = "updatetester"
-    user = create_test_user(db_session, username, "userpass123")
-    token = get_auth_token(username)
-    headers = {"Authorization": f"Bearer {token}"}
+    username = "notfoundtester"
+    _, headers = user_ctx(username, "userpass123")
 
     non_existent_id = 999999  # A user ID that shouldn't exist
 
-    response = client.put(
-        f"/auth/users/{non_existent_id}", json={"username": "newname"}, headers=headers
+    response = client.request(
+        method, f"/auth/users/{non_existent_id}", json=body, headers=headers
     )
     assert response.status_code == 404
     assert response.json()["detail"] == "User not found"
 
 
-# Test: User not found when deleting
-def test_delete_user_not_found(client: TestClient, db_session: Session):
-    # Create a user
-    username = "deletetester"
-    user = create_test_user(db_session, username, "userpass123")
-    token = get_auth_token(username)
-    headers = {"Authorization": f"Bearer {token}"}
-
-    non_existent_id = 999999  # A user ID that shouldn't exist
-
-    response = client.delete(f"/auth/users/{non_existent_id}", headers=headers)
-    assert response.status_code == 404
-    assert response.json()["detail"] == "User not found"
-
-
 # Test: Username already taken when updating
-def test_update_username_already_taken(client: TestClient, db_session: Session):
+def test_update_username_already_taken(
+    client: TestClient, db_session: Session, user_ctx
+):
     # Create two users
     username1 = "firstuser"
     user1 = create_test_user(db_session, username1, "userpass123")
 
     username2 = "seconduser"
-    user2 = create_test_user(db_session, username2, "userpass123")
-    token = get_auth_token(username2)
-    headers = {"Authorization": f"Bearer {token}"}
+    user2, headers = user_ctx(username2, "userpass123")
 
     # Try to update second user with first user's username
     response = client.put(
@@ -428,3 +435,11 @@ def test_update_username_already_taken(client: TestClient, db_session: Session):
     )
     assert response.status_code == 400
     assert response.json()["detail"] == "Username already taken"
+
+
+# Test: Every route is registered once
+def test_routes_registered_once(client: TestClient):
+    routes = [
+        (r.path, tuple(sorted(getattr(r, "methods", ())))) for r in client.app.routes
+    ]
+    assert len(set(routes)) == len(routes)
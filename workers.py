@@ -0,0 +1,15 @@
+from uvicorn.workers import UvicornWorker
+
+
+class NoDeflateUvicornWorker(UvicornWorker):
+    # Broadcasts send the same payload to every peer, so per-connection
+    # permessage-deflate would compress it once per socket and keep a zlib
+    # context alive for each one. Collaboration messages are small edits anyway.
+    # uvloop and httptools are pinned instead of "auto", so a build missing them
+    # fails at boot rather than quietly serving on asyncio and h11.
+    CONFIG_KWARGS = {
+        **UvicornWorker.CONFIG_KWARGS,
+        "loop": "uvloop",
+        "http": "httptools",
+        "ws_per_message_deflate": False,
+    }